@@ -11,16 +11,18 @@ Features:
 - view and edit the system message.
 - view the chat history.
 - save and restore a session from a log file.
+- search all saved sessions and restore a conversation from a search hit.
 - view metrics for each response.
 - reset the application state.
 - view the session state and model information.
 - view the available models and running models.
+- compare the responses of several models to the same prompt.
 - data grooming module for simple text wrangling.
 """
 
 import logging
+import time
 import streamlit as st
-import ollama
 
 # Moved most functions to another file to reduce clutter
 # The moved functions either take no arguments or take specific arguments
@@ -30,25 +32,63 @@ from ChatbotUtilities import (
         InitializeLogging,
         load_key,
         update_key,
-        StreamData,
+        ModelDetails,
+        StartResponse,
+        FollowResponse,
+        CancelResponse,
         SetSystemMessage,
         DisplayChatHistory,
         UpdateSessionLogs,
         RestoreSessionLogs,
         InventoryModels,
         ResetModel,
+        KeepAlive,
+        KEEP_ALIVE_CHOICES,
+        KEEP_ALIVE_DEFAULT,
         ResetModule,
-        DebuggingModule)
+        DebuggingModule,
+        RerunFragment,
+        LogRunTime)
+
+# Identical requests can be answered from the response cache in ChatbotCache.py
+from ChatbotCache import (ResponseCacheKey)
+
+# In Document Mode only the parts of the attached documents relevant to each question are sent, see ChatbotDocuments.py
+from ChatbotDocuments import (GroundedContext,DocumentsPanel)
+
+# Only as much of the conversation as fits the context token limit is sent, see ChatbotContext.py
+from ChatbotContext import (
+        TrimContext,
+        SummarizedContext,
+        CollectSummary,
+        CancelSummary,
+        UpdateSummary,
+        AutoContextSize,
+        ContextReload,
+        MemoryContext,
+        UpdateMemory)
+
+# Memory Mode needs an embedding model for the earlier turns, see ChatbotVectors.py
+from ChatbotVectors import (EmbeddingModelSelect)
 
 # The Wrangler data grooming module is in ChatbotWrangler.py
 # This isolates the complexity and makes it easier to eliminate
 from ChatbotWrangler import (WranglerModule)
 
+# The Compare module sends one prompt to several models at once and shows the responses side by side
+from ChatbotCompare import (CompareModule)
+
+# The Residency module shows the loaded models and unloads them by hand or to keep within a budget
+from ChatbotResidency import (ResidencyModule)
+
+# The Search module finds words in every saved session and restores a conversation from a hit
+from ChatbotSearch import (SearchModule)
+
 def GenerateNextResponse(session):
     """ Handle prompt submission
-    Add the user's prompt to the messages list, then obtain and add the LLM response
-    Save the metrics to the chatbot metrics list
+    Add the user's prompt to the messages list, then start generating the LLM response in the background
     The LLM query includes the current temperature and context size
+    The response is shown and saved by FinishResponse
     """
     # Get all the keys from the session dictionary - even those we don't use
     messages_key=session['messages_key']
@@ -61,40 +101,107 @@ def GenerateNextResponse(session):
     old_model_key=session['old_model_key']
     session_log_key=session['session_log_key']
     metrics_log_key=session['metrics_log_key']
+    job_key=session['job_key']
+    summary_key=session['summary_key']
+    keep_alive_key=session['keep_alive_key']
+    documents_key=session['documents_key']
     # Append the user prompt to the messages list
     message={'role':'user',
              'content':st.session_state[prompt_key]
             }
     st.session_state[messages_key].append(message)
-    # Get the model response and metrics
-    response_metrics='metrics'
-    stream=ollama.chat(
-            model=st.session_state[model_key],
-            messages=st.session_state[messages_key],
-            options={'temperature':st.session_state[temperature_key],
-                     'num_ctx':st.session_state[context_key]},
-            stream=True)
-    with st.expander(
-                label='Response',
-                expanded=True,
-                icon=':material/smart_toy:'):
-        response_text=st.write_stream(StreamData(stream,response_metrics,temperature_key,context_key,system_key))
+    # Start the model response in the background
+    model=st.session_state[model_key]
+    # In Summary Mode the older turns are replaced by their summary once it is ready
+    conversation=st.session_state[messages_key]
+    summarized_messages=0
+    if st.session_state['summary_mode']:
+        CollectSummary(summary_key)
+        conversation,summarized_messages=SummarizedContext(conversation,st.session_state.get(summary_key))
+    # In Memory Mode only the latest turns and the earlier turns most like the question are sent
+    memory_details=dict()
+    if st.session_state['memory_mode']:
+        conversation,memory_details=MemoryContext(conversation,st.session_state['memory_model'],job_key)
+    # In Document Mode the question is sent with the most relevant parts of the attached documents
+    document_details=dict()
+    if st.session_state['document_mode'] and st.session_state.get(documents_key):
+        conversation,document_details=GroundedContext(conversation,documents_key)
+    # In Automatic Context Size mode the context token limit grows in coarse steps to fit the conversation
+    num_ctx=st.session_state[context_key]
+    if st.session_state['auto_context_mode']:
+        num_ctx=AutoContextSize(conversation,st.session_state.get(context_key+'_auto'),
+                                st.session_state['sys_models'][model]['context_length'])
+        st.session_state[context_key+'_auto']=num_ctx
+    details=ModelDetails(model,st.session_state[temperature_key],
+                         num_ctx,st.session_state[system_key])
+    details.update(ContextReload(st.session_state[metrics_key],model,num_ctx))
+    options={'temperature':st.session_state[temperature_key],
+             'num_ctx':num_ctx}
+    # Drop the oldest turns that don't fit the context token limit rather than let Ollama truncate them
+    messages,dropped_messages,dropped_tokens=TrimContext(conversation,options['num_ctx'])
+    details['context_summarized_messages']=summarized_messages
+    details['context_dropped_messages']=dropped_messages
+    details['context_dropped_tokens']=dropped_tokens
+    details.update(memory_details)
+    details.update(document_details)
+    # With the response cache on, an identical earlier request is replayed instead of asking the model again
+    cache_key=None
+    if st.session_state['cache_mode']:
+        cache_key=ResponseCacheKey(st.session_state['sys_models'][model]['digest'],
+                                   messages,options)
+    StartResponse(job_key,model,messages,options,details,cache_key,KeepAlive(keep_alive_key))
+    # Clear the prompt after it is successfully submitted
+    st.session_state[prompt_key]=str()
+    # Rerun to show the prompt in the chat history and attach to the response
+    RerunFragment()
+
+def FinishResponse(session):
+    """ Show the response being generated in the background as it streams
+    When it is complete add it to the messages list and save the metrics to the chatbot metrics list
+    If the user switches pages first, the response keeps generating and this attaches again on return
+    """
+    messages_key=session['messages_key']
+    metrics_key=session['metrics_key']
+    session_log_key=session['session_log_key']
+    metrics_log_key=session['metrics_log_key']
+    job_key=session['job_key']
+    summary_key=session['summary_key']
+    keep_alive_key=session['keep_alive_key']
+    documents_key=session['documents_key']
+    job=FollowResponse(job_key)
+    if job['error']:
+        del st.session_state[job_key]
+        st.error(f'The model did not respond: {job["error"]}',icon=':material/error:')
+        return
     message={'role':'assistant',
-            'content':response_text
+            'content':''.join(job['chunks'])
             }
     st.session_state[messages_key].append(message)
-    st.session_state[metrics_key].append(st.session_state[response_metrics])
-    # Clear the prompt after it is successfully submitted
-    st.session_state[prompt_key]=str()
+    st.session_state[metrics_key].append(job['metrics'])
+    del st.session_state[job_key]
     # Save the session and metrics logs
     UpdateSessionLogs(session_log_key,metrics_log_key,messages_key,metrics_key)
-    st.rerun()
+    # Summarize the older turns while the user reads the response and types the next prompt
+    if st.session_state['summary_mode']:
+        UpdateSummary(summary_key,job_key,job['model'],st.session_state[messages_key],job['details']['num_ctx'],
+                      KeepAlive(keep_alive_key))
+    # In Memory Mode embed the finished turn while the user reads the response
+    if st.session_state['memory_mode']:
+        UpdateMemory(job_key,st.session_state['memory_model'],st.session_state[messages_key])
+    RerunFragment()
 
 def ChatbotModule():
     """ The main chatbot module.
     Only when this module is selected will the sidebar show
     - Prompt edit mode
     - Clipboard mode
+    - Batched streaming mode
+    - Response cache mode
+    - Summary mode
+    - Automatic context size mode
+    - Hedged requests mode
+    - Memory mode
+    - Document mode
     - Multi-session mode
     """
     # Provide a toggle to enable editing the prompt
@@ -108,6 +215,43 @@ def ChatbotModule():
             value=False,
             help='Enable mode to add a copy to clipboard icon on messages.',
             key='clipboard_mode')
+    batch_mode=st.sidebar.toggle(
+            label='Batched Streaming',
+            value=True,
+            help='Show streamed responses in small batches of tokens instead of one token at a time.',
+            key='batch_mode')
+    cache_mode=st.sidebar.toggle(
+            label='Response Cache',
+            value=False,
+            help='Replay saved responses to identical requests (same model, messages, temperature, and context size).',
+            key='cache_mode')
+    summary_mode=st.sidebar.toggle(
+            label='Summary Mode',
+            value=False,
+            help='Summarize the older turns of long chats so each prompt stays short. The full chat is still shown and saved.',
+            key='summary_mode')
+    auto_context_mode=st.sidebar.toggle(
+            label='Automatic Context Size',
+            value=False,
+            help='Set the context token limit from the length of each chat, growing in a few large steps.',
+            key='auto_context_mode')
+    hedge_mode=st.sidebar.toggle(
+            label='Hedged Requests',
+            value=False,
+            help='If a response is slow to start, ask a second Ollama host too and use whichever answers first. Needs OLLAMA_HOSTS.',
+            key='hedge_mode')
+    memory_mode=st.sidebar.toggle(
+            label='Memory Mode',
+            value=False,
+            help='In long chats, send the latest turns and only the earlier turns most like the question, found with an embedding model.',
+            key='memory_mode')
+    if memory_mode:
+        EmbeddingModelSelect('memory_model','Each earlier turn is embedded once with this model.',st.sidebar)
+    document_mode=st.sidebar.toggle(
+            label='Document Mode',
+            value=False,
+            help='Attach documents to a chat. Only the parts most relevant to each question are sent with it.',
+            key='document_mode')
     # Provide a toggle to enable multi-session mode
     multi_mode=st.sidebar.toggle(
             label='Multi-Session Mode',
@@ -151,6 +295,10 @@ def MultiChatbotInterface():
 
 def ChatOne():
     """ Page for chat number 1 """
+    ChatbotSessionHandler(ChatOneSession())
+
+def ChatOneSession():
+    """ The session dictionary for chat number 1. The Search module restores conversations into this chat. """
     # Define the keys used to store the session state values in a dictionary
     # This allows the same code to be used for mutli-session and single session chatbots
     # All of the single or first session keys start with 'cb_' to help identify them in the debugging module
@@ -165,7 +313,11 @@ def ChatOne():
     session['old_model_key']='cb_model_old'
     session['session_log_key']='cb_session_log_file'
     session['metrics_log_key']='cb_metrics_log_file'
-    ChatbotSessionHandler(session)
+    session['job_key']='cb_job'
+    session['summary_key']='cb_summary'
+    session['keep_alive_key']='cb_keep_alive'
+    session['documents_key']='cb_documents'
+    return session
 
 def ChatTwo():
     """ Page for chat number 2 """
@@ -181,6 +333,10 @@ def ChatTwo():
     session['old_model_key']='c2_model_old'
     session['session_log_key']='c2_session_log_file'
     session['metrics_log_key']='c2_metrics_log_file'
+    session['job_key']='c2_job'
+    session['summary_key']='c2_summary'
+    session['keep_alive_key']='c2_keep_alive'
+    session['documents_key']='c2_documents'
     ChatbotSessionHandler(session)
 
 def ChatThree():
@@ -197,6 +353,10 @@ def ChatThree():
     session['old_model_key']='c3_model_old'
     session['session_log_key']='c3_session_log_file'
     session['metrics_log_key']='c3_metrics_log_file'
+    session['job_key']='c3_job'
+    session['summary_key']='c3_summary'
+    session['keep_alive_key']='c3_keep_alive'
+    session['documents_key']='c3_documents'
     ChatbotSessionHandler(session)
 
 def SingleChatbotInterface():
@@ -206,6 +366,11 @@ def SingleChatbotInterface():
     st.divider()
     ChatOne()
 
+def OpenChatbot():
+    """ Show the chatbot module, after the Search module restores a conversation into it."""
+    st.session_state['module']='Chatbot'
+    st.rerun()
+
 def ChatbotSessionHandler(session):
     # Define variables for each of the keys from the session dictionary
     # This makes reading the code easier and makes the multisession code cleaner
@@ -219,6 +384,10 @@ def ChatbotSessionHandler(session):
     old_model_key=session['old_model_key']
     session_log_key=session['session_log_key']
     metrics_log_key=session['metrics_log_key']
+    job_key=session['job_key']
+    summary_key=session['summary_key']
+    keep_alive_key=session['keep_alive_key']
+    documents_key=session['documents_key']
     # Set up the first row of buttons
     button_cols=st.columns(3,vertical_alignment='top')
     button_cols[0].markdown('Select Ollama Model')
@@ -237,11 +406,22 @@ def ChatbotSessionHandler(session):
             help='Select the model to use for the chatbot',
             key='_'+model_key,
             on_change=ResetModel,
-            args=[model_key,old_model_key,system_key])
+            args=[model_key,old_model_key,system_key,context_key,keep_alive_key,job_key])
     if model_key not in st.session_state.keys():
         st.session_state[model_key]=model
     if old_model_key not in st.session_state.keys():
         st.session_state[old_model_key]=model
+    # How long Ollama keeps the model loaded after each response in this session
+    if keep_alive_key not in st.session_state.keys():
+        st.session_state[keep_alive_key]=KEEP_ALIVE_DEFAULT
+    load_key(keep_alive_key)
+    button_cols[0].selectbox(
+            'Keep model loaded',
+            list(KEEP_ALIVE_CHOICES.keys()),
+            help='How long Ollama keeps the model loaded after each response. A loaded model answers without the load time.',
+            key='_'+keep_alive_key,
+            on_change=update_key,
+            args=[keep_alive_key])
     # New Chat button
     button_cols[1].markdown('Start a new chat session')
     new_chat_btn=button_cols[1].button(
@@ -261,6 +441,14 @@ def ChatbotSessionHandler(session):
             del st.session_state[metrics_log_key]
         if prompt_key in st.session_state.keys():
             del st.session_state[prompt_key]
+        CancelResponse(job_key)
+        if summary_key in st.session_state.keys():
+            del st.session_state[summary_key]
+        if documents_key in st.session_state.keys():
+            del st.session_state[documents_key]
+        if context_key+'_auto' in st.session_state.keys():
+            del st.session_state[context_key+'_auto']
+        CancelSummary(summary_key)
         st.rerun()
     # Restore Chat button
     button_cols[2].markdown('Restore a previous chat session')
@@ -269,11 +457,42 @@ def ChatbotSessionHandler(session):
             help='Restore a previous chat session',
             use_container_width=True)
     if restore_chat_btn:
-        RestoreSessionLogs(messages_key,metrics_key)
+        RestoreSessionLogs(messages_key,metrics_key,session_log_key,metrics_log_key,job_key,summary_key,context_key)
     # Manage the system message
     SetSystemMessage(system_key,model_key)
+    # Attach documents to the chat in Document Mode
+    if st.session_state['document_mode']:
+        DocumentsPanel(documents_key)
+    # The history, sliders, and prompt entry rerun on their own when a prompt is submitted
+    ChatbotConversation(session)
+
+@st.fragment
+def ChatbotConversation(session):
+    """ The conversation pane - chat history, sliders, and prompt entry.
+    This is a fragment, so submitting a prompt or moving a slider reruns only this pane,
+    not the sidebar, model inventory, model selection, and system message.
+    The run time is logged to compare with full script runs."""
+    run_start=time.perf_counter()
+    # Define variables for each of the keys from the session dictionary
+    messages_key=session['messages_key']
+    metrics_key=session['metrics_key']
+    system_key=session['system_key']
+    prompt_key=session['prompt_key']
+    temperature_key=session['temperature_key']
+    context_key=session['context_key']
+    model_key=session['model_key']
+    old_model_key=session['old_model_key']
+    session_log_key=session['session_log_key']
+    metrics_log_key=session['metrics_log_key']
+    job_key=session['job_key']
+    summary_key=session['summary_key']
+    keep_alive_key=session['keep_alive_key']
+    documents_key=session['documents_key']
     # Display the chat history if it exists
     DisplayChatHistory(messages_key,system_key,metrics_key)
+    # Show the response being generated, if there is one
+    if job_key in st.session_state:
+        FinishResponse(session)
     # Set up the second row of buttons
     # The submit button is only shown in editor mode
     if st.session_state['editor_mode'] == False:
@@ -304,14 +523,18 @@ def ChatbotSessionHandler(session):
             min_value=1024,
             max_value=max_context_size,
             step=1024,
+            disabled=st.session_state['auto_context_mode'],
             key=context_key)
+    if st.session_state['auto_context_mode']:
+        auto_context_size=st.session_state.get(context_key+'_auto','not set until the first question')
+        slider_cols[1].caption(f'Automatic context token limit: {auto_context_size}')
     # There are two ways to get the user prompt:
     # 1. Use st.chat_input() to get the user prompt and submit it. This is the default.
     # 2. Use st.text_area() for more complex editing of the user prompt and submit it with a button.
     #
     if st.session_state['editor_mode'] == False:
         # Here is option 1 - using st.chat_input()
-        # The st.chat_input always displays at the bottom of the screen.
+        # Inside the conversation fragment st.chat_input displays below the sliders, not pinned to the bottom.
         # Pressing return submits the prompt, which makes it impossible to structure a prompt with context.
         if chatbot_prompt:=st.chat_input():
             st.session_state[prompt_key]=chatbot_prompt
@@ -338,6 +561,7 @@ def ChatbotSessionHandler(session):
                     height=100,
                     on_change=update_key,
                     args=[prompt_key])
+    LogRunTime(f'{messages_key} conversation pane',run_start)
 
 if __name__=='__main__':
     # The Chatbot application itself.
@@ -359,30 +583,45 @@ if __name__=='__main__':
                     'Report a bug': None,
                     'About': '# Ollama Chatbot'
                     } )
+    run_start=time.perf_counter()
     # set up logging to a log file and the console
     if 'log' not in st.session_state:
         st.session_state['log']=logging.getLogger()
         InitializeLogging()
     # Inventory available Ollama models, adding features/parameters to st.session_state
-    # This should only run once as the results are cached using @st.cache_data.
+    # All sessions share one registry (st.cache_resource), refreshed in the background when models change.
     InventoryModels()
     # Set up the basic sidebar
     st.sidebar.header('Ollama Chatbot')
     module_list=(
             'Chatbot',
+            'Compare',
+            'Residency',
+            'Search',
             'Wrangler',
             'Debugging',
             'Reset')
+    # The module is kept in 'module' so the Search module can switch to the chatbot
+    load_key('module')
     module=st.sidebar.selectbox(
             'Select a module',
             module_list,
-            key='module')
+            key='_module',
+            on_change=update_key,
+            args=['module'])
     # Run the selected module
-    match module:
-        case 'Chatbot': ChatbotModule()
-        case 'Wrangler': WranglerModule()
-        case 'Debugging': DebuggingModule()
-        case 'Reset': ResetModule()
-        case _: st.write(':construction_worker: Something is broken.')
+    # The run time is logged even when the module ends the run early with st.rerun()
+    try:
+        match module:
+            case 'Chatbot': ChatbotModule()
+            case 'Compare': CompareModule()
+            case 'Residency': ResidencyModule()
+            case 'Search': SearchModule(ChatOneSession(),OpenChatbot)
+            case 'Wrangler': WranglerModule()
+            case 'Debugging': DebuggingModule()
+            case 'Reset': ResetModule()
+            case _: st.write(':construction_worker: Something is broken.')
+    finally:
+        LogRunTime('Chatbot script',run_start)
 
 # vim: set expandtab tabstop=4 shiftwidth=4 autoindent:
\ No newline at end of file
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+""" Route requests across several Ollama hosts.
+Set OLLAMA_HOSTS to a comma separated list of Ollama base URLs, for example
+    OLLAMA_HOSTS=http://gpu1:11434,http://gpu2:11434
+Without it, every request goes to OLLAMA_HOST.
+The pool checks each host with list() and ps() every BACKEND_CHECK_SECONDS in a background
+thread. Each response, summary, and prewarm goes to the healthy host with the model that has
+the fewest requests in flight from this server, preferring a host that already has the model
+loaded. A conversation stays on the same host while that host is not much busier than the others,
+so Ollama can reuse the cached prompt from the previous turn.
+"""
+import time
+import queue
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import streamlit as st
+from ChatbotClient import (OLLAMA_HOSTS,OllamaClient,RaceClient)
+from ChatbotScheduler import (WaitForSlot,ReleaseSlot)
+
+BACKEND_HOSTS=OLLAMA_HOSTS
+BACKEND_CHECK_SECONDS=30
+# A conversation moves to another host only when its host has more than BACKEND_STICKY_SLACK
+# more requests in flight than the least loaded host
+BACKEND_STICKY_SLACK=1
+# In Hedged Requests mode, a response that has no token after HEDGE_DELAY_SECONDS is also
+# requested from a second host. The first host to send a token wins and the other request is closed.
+# The second request waits for a slot from the scheduler like any other request.
+HEDGE_DELAY_SECONDS=2.0
+
+@st.cache_resource
+def BackendPool():
+    """ The process-wide backend pool, shared by every browser session.
+    - hosts: for each host, its models, loaded models, health, and requests in flight
+    - conversations: the host last used by each conversation
+    - checked: when the hosts were last checked, or None before the first check
+    """
+    hosts={host:{'models':set(),'resident':set(),'healthy':True,'inflight':0} for host in BACKEND_HOSTS}
+    return {'hosts':hosts,
+            'conversations':dict(),
+            'checked':None,
+            'lock':threading.Lock()}
+
+def CheckBackend(host,client):
+    """ Return the models on a host, the models it has loaded, and whether it responded."""
+    try:
+        models={m['model'] for m in client.list()['models']}
+        resident={m['model'] for m in client.ps()['models']}
+        return host,models,resident,True
+    except Exception as e:
+        logging.getLogger().warning(f'Ollama host {host} did not respond: {e}')
+        return host,set(),set(),False
+
+def RefreshBackends(pool,clients):
+    """ Check all the hosts at once. After the first check this runs in a background thread,
+    so it must not call Streamlit."""
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        results=list(executor.map(lambda host: CheckBackend(host,clients[host]),clients))
+    with pool['lock']:
+        for host,models,resident,healthy in results:
+            pool['hosts'][host].update({'models':models,'resident':resident,'healthy':healthy})
+    pool['checked']=time.monotonic()
+
+def ConversationId(session,job_key):
+    """ The pool's name for a conversation: the browser session and the job key of its chat."""
+    return session+' '+job_key
+
+def BackendClients(pool):
+    """ The shared client for each host, for use in background threads."""
+    return {host:OllamaClient(host) for host in pool['hosts']}
+
+def SelectBackend(pool,clients,conversation,model):
+    """ Pick the host for a response and count it as in flight until EndRequest.
+    If no healthy host has the model, the conversation's last host or the first host is used,
+    and the request reports the error. clients is from BackendClients."""
+    if len(pool['hosts'])>1:
+        if pool['checked'] is None:
+            RefreshBackends(pool,clients)
+        elif time.monotonic()-pool['checked']>BACKEND_CHECK_SECONDS:
+            # Claim this check so other sessions don't start one too
+            pool['checked']=time.monotonic()
+            threading.Thread(target=RefreshBackends,args=[pool,clients],daemon=True).start()
+    with pool['lock']:
+        hosts=pool['hosts']
+        sticky=pool['conversations'].get(conversation)
+        candidates=[h for h,state in hosts.items() if state['healthy'] and model in state['models']]
+        if len(hosts)==1:
+            host=BACKEND_HOSTS[0]
+        elif not candidates:
+            host=sticky or BACKEND_HOSTS[0]
+        else:
+            least=min(hosts[h]['inflight'] for h in candidates)
+            if sticky in candidates and hosts[sticky]['inflight']<=least+BACKEND_STICKY_SLACK:
+                host=sticky
+            else:
+                host=min(candidates,key=lambda h:(hosts[h]['inflight'],model not in hosts[h]['resident']))
+        pool['conversations'][conversation]=host
+        hosts[host]['inflight']+=1
+    return host
+
+def EndRequest(pool,host,model,error=None):
+    """ Count a response as complete. A host that can't be reached is skipped until the next check.
+    This is called from the background response thread."""
+    with pool['lock']:
+        state=pool['hosts'][host]
+        state['inflight']=max(state['inflight']-1,0)
+        if error is None:
+            state['resident'].add(model)
+        elif isinstance(error,httpx.TransportError):
+            state['healthy']=False
+
+def BackendRequest(conversation,model,request):
+    """ Send a short request, such as an embedding, to the host picked for the conversation, and return its result.
+    request is called with the host's client. Use a conversation name of its own, so the request
+    doesn't move a chat to the host of a different model. This is called in the script run."""
+    pool=BackendPool()
+    clients=BackendClients(pool)
+    host=SelectBackend(pool,clients,conversation,model)
+    error=None
+    try:
+        return request(clients[host])
+    except Exception as e:
+        error=e
+        raise
+    finally:
+        EndRequest(pool,host,model,error)
+
+def HedgeBackend(pool,model,exclude):
+    """ Pick a second host for a hedged request, other than the hosts in exclude,
+    and count it as in flight. Return None if no other healthy host has the model."""
+    with pool['lock']:
+        hosts=pool['hosts']
+        candidates=[h for h,state in hosts.items() if state['healthy'] and model in state['models'] and h not in exclude]
+        if not candidates:
+            return None
+        host=min(candidates,key=lambda h:(hosts[h]['inflight'],model not in hosts[h]['resident']))
+        hosts[host]['inflight']+=1
+    return host
+
+def HedgedChat(job,messages,options):
+    """ Start the request on the job's host and return a generator of its chunks, like a streaming chat.
+    If no token arrives within HEDGE_DELAY_SECONDS, or the first host fails, the same request is sent
+    to a second host, and the chunks come from whichever host sends a token first.
+    This is called from the background response thread."""
+    race={'events':queue.Queue(),
+          'winner':None,
+          'stop':False,
+          'decided':threading.Event(),
+          'sockets':dict()}
+    StartRacer(job,race,job['host'],messages,options)
+    return HedgeFollower(job,race,messages,options)
+
+def StartRacer(job,race,host,messages,options,hedge=False):
+    """ Start one of the hedged requests in its own thread."""
+    threading.Thread(target=HedgeRacer,args=[job,race,host,messages,options,hedge],daemon=True).start()
+
+def HedgeRacer(job,race,host,messages,options,hedge):
+    """ Pass the chunks from one host to the follower, until another host wins or the race is stopped.
+    The job's own request already has a scheduler slot. The hedge request waits for one,
+    and gives up if a winner is decided while it waits."""
+    error=None
+    if hedge and WaitForSlot(job['scheduler'],job['session'],job['model'],race['decided']) is None:
+        EndRequest(job['backends'],host,job['model'])
+        race['events'].put((host,None))
+        return
+    try:
+        stream=RaceClient(host,race['sockets']).chat(
+                model=job['model'],
+                messages=messages,
+                options=options,
+                keep_alive=job['keep_alive'],
+                stream=True)
+        for chunk in stream:
+            if RaceLost(race,host):
+                break
+            race['events'].put((host,chunk))
+    except Exception as e:
+        # A request closed by CloseRace fails, but the host is fine
+        if not RaceLost(race,host):
+            error=e
+            race['events'].put((host,e))
+    if hedge:
+        ReleaseSlot(job['scheduler'],job['model'])
+    EndRequest(job['backends'],host,job['model'],error)
+    race['events'].put((host,None))
+
+def RaceLost(race,host):
+    return race['stop'] or race['winner'] not in (None,host)
+
+def CloseRace(race,keep=None):
+    """ Close the connections of every request in the race but keep's, so Ollama stops generating them."""
+    for host,sock in list(race['sockets'].items()):
+        if host!=keep:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Already closed
+                pass
+
+def HedgeFollower(job,race,messages,options):
+    """ Yield the chunks of the winning host. The losing request is closed as soon as the winner is decided.
+    The hedge results are added to the job details:
+    - hedged: a second request was sent
+    - hedge_won: the second request won
+    - host: the winning host
+    """
+    details=job['details']
+    hosts=[job['host']]
+    failed=set()
+    hedge_tried=False
+    first_error=None
+    deadline=time.monotonic()+HEDGE_DELAY_SECONDS
+    try:
+        while True:
+            timeout=None
+            if race['winner'] is None and not hedge_tried:
+                timeout=max(deadline-time.monotonic(),0)
+            try:
+                host,item=race['events'].get(timeout=timeout)
+            except queue.Empty:
+                hedge_tried=True
+                hedge_host=HedgeBackend(job['backends'],job['model'],hosts)
+                if hedge_host:
+                    hosts.append(hedge_host)
+                    details['hedged']=True
+                    logging.getLogger().info(f'Hedged {job["model"]} request from {hosts[0]} to {hedge_host}')
+                    StartRacer(job,race,hedge_host,messages,options,hedge=True)
+                elif first_error:
+                    raise first_error
+                continue
+            if item is None:
+                if host==race['winner']:
+                    return
+                continue
+            if isinstance(item,Exception):
+                failed.add(host)
+                if host==race['winner'] or (hedge_tried and failed==set(hosts)):
+                    raise item
+                if not hedge_tried:
+                    # Try the second host now rather than after the delay
+                    first_error=item
+                    deadline=time.monotonic()
+                continue
+            if race['winner'] is None:
+                race['winner']=host
+                race['decided'].set()
+                CloseRace(race,keep=host)
+                details['host']=host
+                details['hedge_won']=host!=hosts[0]
+                with job['backends']['lock']:
+                    job['backends']['conversations'][job['conversation']]=host
+            if host==race['winner']:
+                yield item
+    finally:
+        # The response is complete, failed, or stopped by the user
+        race['stop']=True
+        race['decided'].set()
+        CloseRace(race)
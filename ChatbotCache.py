@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+""" Response cache for repeated prompts.
+A response is keyed by a hash of the model digest, the full message list, and the options.
+Recent responses are kept in memory. All responses are saved on disk until the cache grows
+past its size limit, then the least recently used files are removed.
+The cache is shared by every session in the Streamlit server process.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+CACHE_DIRECTORY='ChatbotCache'
+CACHE_MEMORY_ENTRIES=256
+CACHE_DISK_BYTES=100*1024*1024
+
+memory_cache=OrderedDict()
+cache_lock=threading.Lock()
+
+def ResponseCacheKey(digest,messages,options):
+    """ A stable hash of everything that determines the response.
+    Only role and content are used from each message."""
+    request={'digest':digest,
+             'messages':[[msg['role'],msg['content']] for msg in messages],
+             'temperature':options.get('temperature'),
+             'num_ctx':options.get('num_ctx')}
+    text=json.dumps(request,sort_keys=True,ensure_ascii=False)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def CacheFile(key):
+    """ The disk tier file for a cache key."""
+    return os.path.join(CACHE_DIRECTORY,key+'.json')
+
+def LookupResponse(key):
+    """ Return the cached response for the key, or None.
+    A cached response is a dictionary with the response chunks and the original metrics.
+    A hit on disk is promoted to memory and its file time is updated for the eviction order."""
+    with cache_lock:
+        if key in memory_cache:
+            memory_cache.move_to_end(key)
+            return memory_cache[key]
+    try:
+        with open(CacheFile(key), 'r', encoding='utf-8') as f:
+            entry=json.load(f)
+        os.utime(CacheFile(key))
+    except (OSError, json.JSONDecodeError):
+        return None
+    RememberResponse(key,entry)
+    return entry
+
+def RememberResponse(key,entry):
+    """ Add a response to the memory tier, dropping the least recently used past the limit."""
+    with cache_lock:
+        memory_cache[key]=entry
+        memory_cache.move_to_end(key)
+        while len(memory_cache)>CACHE_MEMORY_ENTRIES:
+            memory_cache.popitem(last=False)
+
+def StoreResponse(key,chunks,metrics):
+    """ Save a complete response in both tiers, then trim the disk tier to its size limit.
+    This is called from the background response thread."""
+    entry={'chunks':list(chunks),'metrics':dict(metrics)}
+    RememberResponse(key,entry)
+    try:
+        os.makedirs(CACHE_DIRECTORY,exist_ok=True)
+        temp_file=CacheFile(key)+'.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(entry,f)
+        os.replace(temp_file,CacheFile(key))
+        TrimDiskCache()
+    except OSError as e:
+        logging.getLogger().warning(f'Response cache write failed: {e}')
+
+def TrimDiskCache():
+    """ Remove the least recently used cache files until the total size is under CACHE_DISK_BYTES."""
+    files=list()
+    total=0
+    with os.scandir(CACHE_DIRECTORY) as entries:
+        for entry in entries:
+            if entry.name.endswith('.json'):
+                info=entry.stat()
+                files.append((info.st_mtime,info.st_size,entry.path))
+                total+=info.st_size
+    files.sort()
+    while total>CACHE_DISK_BYTES and files:
+        mtime,size,path=files.pop(0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total-=size
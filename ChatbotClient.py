@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+""" The shared Ollama client.
+Every request from every browser session goes through one client per Ollama host, created once
+per process. The client keeps a pool of open HTTP connections, so requests don't pay for a new
+connection each time, and the pool size limits how many requests are sent to Ollama at once.
+A request beyond the limit waits for a connection rather than failing.
+"""
+import os
+import httpx
+import ollama
+import streamlit as st
+
+# The host defaults to OLLAMA_HOST in the environment, the same as the ollama package
+OLLAMA_HOST=os.environ.get('OLLAMA_HOST','http://127.0.0.1:11434')
+# Requests are spread over the hosts in OLLAMA_HOSTS, a comma separated list, see ChatbotBackends.py
+OLLAMA_HOSTS=[h.strip() for h in os.environ.get('OLLAMA_HOSTS',OLLAMA_HOST).split(',') if h.strip()]
+OLLAMA_MAX_CONNECTIONS=16
+OLLAMA_KEEPALIVE_CONNECTIONS=8
+OLLAMA_KEEPALIVE_SECONDS=120
+# Loading a large model can take a minute or more before the first token, so the read timeout is long
+OLLAMA_CONNECT_TIMEOUT=10
+OLLAMA_READ_TIMEOUT=600
+
+OLLAMA_TIMEOUT=httpx.Timeout(
+        connect=OLLAMA_CONNECT_TIMEOUT,
+        read=OLLAMA_READ_TIMEOUT,
+        write=OLLAMA_CONNECT_TIMEOUT,
+        pool=None)
+
+@st.cache_resource
+def OllamaClient(host=OLLAMA_HOST):
+    """ The process-wide client for an Ollama host.
+    Call this in the script run and pass the client to background threads."""
+    return ollama.Client(
+            host=host,
+            timeout=OLLAMA_TIMEOUT,
+            limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OLLAMA_KEEPALIVE_SECONDS))
+
+def RaceClient(host,sockets):
+    """ A client of its own for one request that another thread may have to abandon, see HedgedChat.
+    Its first request always opens a new connection, and the socket is put in sockets[host] as soon as
+    it connects. Shutting the socket down stops the request at once, even before the first token,
+    and Ollama stops working on a request when its connection closes."""
+    def Trace(event,info):
+        if event=='connection.connect_tcp.complete':
+            sockets[host]=info['return_value'].get_extra_info('socket')
+    def AddTrace(request):
+        request.extensions['trace']=Trace
+    return ollama.Client(
+            host=host,
+            timeout=OLLAMA_TIMEOUT,
+            event_hooks={'request':[AddTrace]})
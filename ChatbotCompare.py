@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+""" Side by side comparison of several models answering the same prompt.
+"""
+import time
+import streamlit as st
+
+from ChatbotUtilities import (
+        ModelDetails,
+        StartResponse,
+        FormatMetric)
+
+# The requests are sent to all the models at once, so the total time follows the slowest model
+# rather than the sum of all of them. Ollama must be allowed to hold that many models at once
+# (OLLAMA_MAX_LOADED_MODELS) or the later requests wait for a model to be unloaded.
+COMPARE_MAX_MODELS=4
+COMPARE_REFRESH_SECONDS=0.1
+
+def CompareModule():
+    """ The compare module.
+    Send one prompt, with the same system message and options, to several models
+    and show the responses side by side, followed by a table of their metrics.
+    """
+    st.markdown('### Compare Module')
+    st.divider()
+    model_list=list(st.session_state['sys_models'].keys())
+    models=st.multiselect(
+            'Select models to compare',
+            model_list,
+            default=model_list[:2],
+            max_selections=COMPARE_MAX_MODELS,
+            help=f'Select up to {COMPARE_MAX_MODELS} models',
+            key='cmp_models')
+    if 'cmp_system' not in st.session_state:
+        today=time.strftime('%A, %B %d, %Y')
+        st.session_state['cmp_system']=f'Today is {today}. '
+    st.text_area(
+            label='Edit the system message here:',
+            key='cmp_system',
+            height=68)
+    slider_cols=st.columns(2,vertical_alignment='center')
+    slider_cols[0].slider(
+            label='Temperature',
+            help='Adjust the randomness of the responses',
+            value=0.1,
+            min_value=0.0,
+            max_value=1.0,
+            step=0.1,
+            key='cmp_temperature')
+    # The context size must suit the smallest of the selected models
+    if models:
+        max_context_size=min(st.session_state['sys_models'][m]['context_length'] for m in models)
+    else:
+        max_context_size=102400
+    # The slider takes its value from session_state, which is set here rather than with value=
+    if 'cmp_context' not in st.session_state:
+        st.session_state['cmp_context']=2048
+    if st.session_state['cmp_context']>max_context_size:
+        st.session_state['cmp_context']=max_context_size
+    slider_cols[1].slider(
+            label='Context token limit',
+            help='Adjust the number of context tokens',
+            min_value=1024,
+            max_value=max_context_size,
+            step=1024,
+            key='cmp_context')
+    with st.expander(
+                label='Enter your question here:',
+                expanded=True,
+                icon=':material/person:'):
+        st.text_area(
+                label='Question',
+                label_visibility='collapsed',
+                placeholder='Enter your question here',
+                key='cmp_prompt',
+                height=100)
+    running='cmp_jobs' in st.session_state
+    button_cols=st.columns(4,vertical_alignment='center')
+    compare_btn=button_cols[0].button(
+            'Compare',
+            help='Submit the prompt to all the selected models',
+            disabled=running or not models or not st.session_state['cmp_prompt'],
+            use_container_width=True)
+    button_cols[1].button(
+            'Stop',
+            help='Stop generating all the responses',
+            disabled=not running,
+            on_click=StopComparison,
+            use_container_width=True)
+    if compare_btn:
+        StartComparison(models)
+    st.divider()
+    if 'cmp_jobs' in st.session_state:
+        FollowComparison()
+    if 'cmp_results' in st.session_state:
+        DisplayComparison()
+
+def StartComparison(models):
+    """ Start a background response for each selected model. """
+    messages=list()
+    if st.session_state['cmp_system']:
+        messages.append({'role':'system','content':st.session_state['cmp_system']})
+    messages.append({'role':'user','content':st.session_state['cmp_prompt']})
+    options={'temperature':st.session_state['cmp_temperature'],
+             'num_ctx':st.session_state['cmp_context']}
+    if 'cmp_results' in st.session_state:
+        del st.session_state['cmp_results']
+    job_keys=list()
+    st.session_state['cmp_start']=time.perf_counter()
+    for i,model in enumerate(models):
+        job_key=f'cmp_job_{i}'
+        details=ModelDetails(model,options['temperature'],options['num_ctx'],st.session_state['cmp_system'])
+        StartResponse(job_key,model,messages,options,details)
+        job_keys.append(job_key)
+    st.session_state['cmp_jobs']=job_keys
+
+def StopComparison():
+    """ Cancel every response that is still being generated. """
+    for job_key in st.session_state.get('cmp_jobs',list()):
+        st.session_state[job_key]['cancel'].set()
+
+def FollowComparison():
+    """ Show the responses in side by side columns as they stream, until they are all complete.
+    Then save the responses and metrics so they are shown until the next comparison."""
+    job_keys=st.session_state['cmp_jobs']
+    jobs=[st.session_state[k] for k in job_keys]
+    status=st.empty()
+    columns=st.columns(len(jobs))
+    placeholders=list()
+    for column,job in zip(columns,jobs):
+        column.markdown(f'**{job["model"]}**')
+        placeholders.append(column.empty())
+    shown=[0]*len(jobs)
+    while True:
+        # Check done before rendering so the last of the text is shown
+        all_done=all(job['done'] for job in jobs)
+        for i,job in enumerate(jobs):
+            available=len(job['chunks'])
+            if available>shown[i]:
+                shown[i]=available
+                placeholders[i].markdown(''.join(job['chunks'][:available]))
+        if all_done:
+            break
+        # Update the status on every pass. This also lets Streamlit interrupt the run
+        # for a page switch or the Stop button while waiting for the first tokens.
+        status.caption(f'{sum(job["done"] for job in jobs)} of {len(jobs)} responses complete, '
+                       f'{sum(shown)} tokens ({time.perf_counter()-st.session_state["cmp_start"]:.1f} seconds)')
+        time.sleep(COMPARE_REFRESH_SECONDS)
+    status.empty()
+    results=list()
+    for job_key,job in zip(job_keys,jobs):
+        results.append({'model':job['model'],
+                        'content':''.join(job['chunks']),
+                        'metrics':job['metrics'],
+                        'error':job['error']})
+        del st.session_state[job_key]
+    st.session_state['cmp_results']=results
+    st.session_state['cmp_seconds']=time.perf_counter()-st.session_state['cmp_start']
+    del st.session_state['cmp_jobs']
+    st.rerun()
+
+def DisplayComparison():
+    """ Show the saved responses side by side, then a table comparing their metrics."""
+    results=st.session_state['cmp_results']
+    columns=st.columns(len(results))
+    for column,result in zip(columns,results):
+        column.markdown(f'**{result["model"]}**')
+        if result['error']:
+            column.error(result['error'],icon=':material/error:')
+        else:
+            column.markdown(result['content'])
+    rows=list()
+    for result in results:
+        metrics=result['metrics']
+        if not metrics:
+            continue
+        rows.append({
+                'Model':result['model'],
+                'Parameter size':metrics['parameter_size'],
+                'Quantization':metrics['quantization_level'],
+                'Stopped':metrics.get('cancelled',False),
+                'Queue wait (s)':FormatMetric(metrics.get('queue_wait'),2),
+                'Time to first token (s)':FormatMetric(metrics['ttft'],2),
+                'Tokens/second':FormatMetric(metrics['eval_rate'],1),
+                'Total duration (s)':FormatMetric(metrics['total_duration'],2,1/1000000000),
+                'Model load (s)':FormatMetric(metrics['load_seconds'],2),
+                'Prompt tokens':metrics['prompt_eval_count'],
+                'Response tokens':metrics['eval_count']})
+    st.divider()
+    slowest=max((r['metrics']['total_duration'] for r in results if r['metrics']),default=0)/1000000000
+    st.caption(f'All responses took {st.session_state["cmp_seconds"]:.2f} seconds. The slowest model took {slowest:.2f} seconds.')
+    st.dataframe(rows,hide_index=True,use_container_width=True)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+""" Manage what part of a conversation is sent to the model.
+The full conversation is always displayed and logged. Only the messages sent with
+each request are trimmed to fit the context token limit (num_ctx), summarized, or,
+in Memory Mode, limited to the latest turns and the earlier turns most like the question.
+"""
+import time
+import logging
+import threading
+import streamlit as st
+from ChatbotResidency import (SessionId)
+from ChatbotScheduler import (Scheduler,WaitForSlot,ReleaseSlot)
+from ChatbotBackends import (BackendPool,BackendClients,ConversationId,SelectBackend,EndRequest,BackendRequest)
+from ChatbotVectors import (VectorIndex,ContentHash,EmbedTexts,EmbedMissing,NearestRows)
+
+# With Summary Mode on, the older turns are summarized by the model in the background once the
+# messages sent grow past SUMMARY_THRESHOLD of the smaller of context_length and num_ctx.
+# The latest SUMMARY_KEEP_TURNS turns are always sent as they are.
+SUMMARY_THRESHOLD=0.5
+SUMMARY_KEEP_TURNS=2
+SUMMARY_PROMPT=('Summarize the conversation below for use as context in the rest of the conversation. '
+                'Keep the facts, names, numbers, decisions, and open questions. Leave out pleasantries. '
+                'Write the summary as plain text, not as a dialogue.')
+SUMMARY_HEADING='Summary of the earlier conversation:\n'
+
+# The messages sent may use CONTEXT_SHARE of num_ctx. The rest is left for the response.
+# Token counts are estimated at CHARS_PER_TOKEN characters per token plus a small overhead
+# per message for the role and formatting.
+CONTEXT_SHARE=0.75
+CHARS_PER_TOKEN=4
+MESSAGE_OVERHEAD_TOKENS=4
+
+def CountTokens(content):
+    """ Estimate the tokens used by a message with this content.
+    This only takes the length, so it isn't cached - a cache keyed by the content would hash
+    and keep every message and document it has seen."""
+    return -(-len(content)//CHARS_PER_TOKEN)+MESSAGE_OVERHEAD_TOKENS
+
+def ConversationTokens(messages):
+    """ Estimate the tokens used by a list of messages."""
+    return sum(CountTokens(msg['content']) for msg in messages)
+
+def TrimContext(messages,num_ctx,share=CONTEXT_SHARE):
+    """ Fit the messages into share of num_ctx by dropping the oldest turns.
+    A turn is a question and everything after it up to the next question.
+    The system message and the latest turn are always kept, even if they don't fit.
+    Return the messages to send, the number of messages dropped, and their estimated tokens."""
+    budget=int(num_ctx*share)
+    total=ConversationTokens(messages)
+    if total<=budget:
+        return list(messages),0,0
+    system=[msg for msg in messages[:1] if msg['role']=='system']
+    conversation=messages[len(system):]
+    turn_starts=[i for i,msg in enumerate(conversation) if msg['role']=='user']
+    # Drop whole turns, oldest first, until the rest fits
+    first_kept=0
+    for turn_start in turn_starts[1:]:
+        if total<=budget:
+            break
+        total-=ConversationTokens(conversation[first_kept:turn_start])
+        first_kept=turn_start
+    dropped=conversation[:first_kept]
+    return system+conversation[first_kept:],len(dropped),ConversationTokens(dropped)
+
+def SummarizedContext(messages,summary):
+    """ Replace the messages covered by the summary with the summary, which is added to the system message.
+    The summary is ignored if the conversation no longer starts with the messages it covers.
+    Return the messages to send and the number of messages summarized."""
+    if not summary or not SummaryMatches(messages,summary):
+        return list(messages),0
+    system=[msg for msg in messages[:1] if msg['role']=='system']
+    content=SUMMARY_HEADING+summary['content']
+    if system:
+        content=system[0]['content']+'\n\n'+content
+    return [{'role':'system','content':content}]+messages[summary['covered']:],summary['covered']-len(system)
+
+def SummaryMatches(messages,summary):
+    """ Check that the summary was made from this conversation.
+    The last message covered is compared, so a restored or new conversation is not summarized by mistake."""
+    covered=summary['covered']
+    return covered<=len(messages) and messages[covered-1]['content']==summary['boundary']
+
+def CollectSummary(summary_key):
+    """ Save the summary from a finished background job in summary_key.
+    Return True if a summary is still being made."""
+    job_key=summary_key+'_job'
+    if job_key not in st.session_state:
+        return False
+    job=st.session_state[job_key]
+    if not job['done']:
+        return True
+    if job['error']:
+        logging.getLogger().warning(f'Summary by {job["model"]} failed: {job["error"]}')
+    else:
+        st.session_state[summary_key]=job['summary']
+    del st.session_state[job_key]
+    return False
+
+def CancelSummary(summary_key):
+    """ Forget the summary being made for a conversation that is replaced.
+    A summary still waiting for a turn from the scheduler is never sent."""
+    job_key=summary_key+'_job'
+    if job_key in st.session_state:
+        st.session_state[job_key]['cancel'].set()
+        del st.session_state[job_key]
+
+def UpdateSummary(summary_key,job_key,model,messages,num_ctx,keep_alive=None):
+    """ Called after each response in Summary Mode.
+    When the messages sent have grown past the threshold, start summarizing
+    everything but the latest turns, including the previous summary, in the background.
+    The summary goes to the host of the conversation of job_key, which has the model loaded.
+    keep_alive is passed on so the summary doesn't change how long the model stays loaded."""
+    if CollectSummary(summary_key):
+        return
+    summary=st.session_state.get(summary_key)
+    if summary and not SummaryMatches(messages,summary):
+        summary=None
+    sent,summarized=SummarizedContext(messages,summary)
+    limit=min(st.session_state['sys_models'][model]['context_length'],num_ctx)
+    if ConversationTokens(sent)<=limit*SUMMARY_THRESHOLD:
+        return
+    turn_starts=[i for i,msg in enumerate(messages) if msg['role']=='user']
+    if len(turn_starts)<=SUMMARY_KEEP_TURNS:
+        return
+    covered=turn_starts[-SUMMARY_KEEP_TURNS]
+    first=summary['covered'] if summary else turn_starts[0]
+    if covered<=first:
+        return
+    transcript=list()
+    if summary:
+        transcript.append(SUMMARY_HEADING+summary['content'])
+    for msg in messages[first:covered]:
+        transcript.append(msg['role'].capitalize()+': '+msg['content'])
+    job={'model':model,
+         'summary':None,
+         'error':None,
+         'cancel':threading.Event(),
+         'done':False}
+    st.session_state[summary_key+'_job']=job
+    request=[{'role':'system','content':SUMMARY_PROMPT},
+             {'role':'user','content':'\n\n'.join(transcript)}]
+    boundary=messages[covered-1]['content']
+    pool=BackendPool()
+    session=SessionId()
+    threading.Thread(target=SummaryWorker,args=[pool,BackendClients(pool),Scheduler(),session,ConversationId(session,job_key),
+                                                job,request,covered,boundary,num_ctx,keep_alive],daemon=True).start()
+
+def SummaryWorker(pool,clients,scheduler,session,conversation,job,request,covered,boundary,num_ctx,keep_alive):
+    """ Make the summary, after waiting for a turn from the scheduler and picking the host like any other request.
+    This runs in a background thread, so it must not call Streamlit or use st.session_state."""
+    if WaitForSlot(scheduler,session,job['model'],job['cancel']) is None:
+        # Cancelled by CancelSummary while waiting - nothing was sent to Ollama
+        job['done']=True
+        return
+    start=time.perf_counter()
+    host=SelectBackend(pool,clients,conversation,job['model'])
+    error=None
+    try:
+        # The same num_ctx as the conversation so Ollama doesn't reload the model
+        response=clients[host].chat(
+                model=job['model'],
+                messages=request,
+                options={'temperature':0.0,'num_ctx':num_ctx},
+                keep_alive=keep_alive)
+        job['summary']={'content':response['message']['content'],
+                        'covered':covered,
+                        'boundary':boundary}
+        logging.getLogger().info(f'Summary by {job["model"]} of the first {covered} messages took {time.perf_counter()-start:.2f} seconds')
+    except Exception as e:
+        error=e
+        job['error']=str(e)
+    EndRequest(pool,host,job['model'],error)
+    ReleaseSlot(scheduler,job['model'])
+    job['done']=True
+
+# With Memory Mode on, the latest MEMORY_KEEP_TURNS turns, counting the new question, are sent as they are.
+# Of the earlier turns, only the MEMORY_TOP_K most similar to the new question are sent.
+# Each turn is embedded in the background after its response, so a question only waits to embed itself.
+MEMORY_KEEP_TURNS=3
+MEMORY_TOP_K=4
+
+def ConversationTurns(messages):
+    """ Split the messages after the system message into turns, each a question and its response.
+    Return the system message as a list, and the turns."""
+    system=[msg for msg in messages[:1] if msg['role']=='system']
+    conversation=messages[len(system):]
+    turn_starts=[i for i,msg in enumerate(conversation) if msg['role']=='user']
+    ends=turn_starts[1:]+[len(conversation)]
+    return system,[conversation[start:end] for start,end in zip(turn_starts,ends)]
+
+def TurnText(turn):
+    """ The text embedded for a turn: its question and response together."""
+    return '\n\n'.join(msg['content'] for msg in turn)
+
+def MemoryContext(messages,model,job_key,keep_turns=MEMORY_KEEP_TURNS,k=MEMORY_TOP_K):
+    """ Send the system message, the earlier turns most similar to the new question, and the latest turns,
+    in their original order. The turns are embedded by UpdateMemory after each response and the vectors
+    are cached by content (see ChatbotVectors.py), so only the new question is embedded here.
+    An earlier turn that isn't embedded yet, such as in a restored chat, is sent, and UpdateMemory is started for it.
+    Return the messages to send and the details for the metrics:
+    - memory_turns_recalled: the number of earlier turns sent because they are like the question
+    - memory_turns_skipped: the number of earlier turns not sent
+    - memory_turns_pending: the number of earlier turns sent because they aren't embedded yet
+    - memory_retrieval_seconds: the time to embed the question and pick the turns
+    If the embedding fails, all the messages are sent and the error is noted."""
+    system,turns=ConversationTurns(messages)
+    if len(turns)<=keep_turns+k:
+        return list(messages),dict()
+    earlier=turns[:-keep_turns]
+    start=time.perf_counter()
+    index=VectorIndex(model)
+    rows=[index['rows'].get(ContentHash(TurnText(turn))) for turn in earlier]
+    if None in rows:
+        UpdateMemory(job_key,model,messages[:-1])
+    try:
+        with st.spinner('Recalling the earlier turns like the question...'):
+            query=BackendRequest(ConversationId(SessionId(),job_key+'_memory'),model,
+                                 lambda client: EmbedTexts(client,model,[messages[-1]['content']]))
+            nearest={row for row,_ in NearestRows(index,query,k,[row for row in rows if row is not None])[0]}
+    except Exception as e:
+        logging.getLogger().error(f'Memory retrieval with {model} failed: {e}')
+        return list(messages),{'memory_error':str(e)}
+    sent=[turn for turn,row in zip(earlier,rows) if row is None or row in nearest]
+    pending=rows.count(None)
+    details={'memory_turns_recalled':len(sent)-pending,
+             'memory_turns_skipped':len(earlier)-len(sent),
+             'memory_turns_pending':pending,
+             'memory_retrieval_seconds':time.perf_counter()-start}
+    return system+[msg for turn in sent+turns[-keep_turns:] for msg in turn],details
+
+def UpdateMemory(job_key,model,messages):
+    """ Called after each response in Memory Mode.
+    Embed the turns of the conversation of job_key that are not in the index yet, in the background."""
+    index=VectorIndex(model)
+    _,turns=ConversationTurns(messages)
+    texts=[TurnText(turn) for turn in turns if turn[-1]['role']=='assistant']
+    missing=[text for text in texts if ContentHash(text) not in index['rows']]
+    if not missing:
+        return
+    pool=BackendPool()
+    threading.Thread(target=MemoryWorker,args=[pool,BackendClients(pool),ConversationId(SessionId(),job_key+'_memory'),
+                                               index,missing],daemon=True).start()
+
+def MemoryWorker(pool,clients,conversation,index,texts):
+    """ Embed the turns on a host with the embedding model.
+    This runs in a background thread, so it must not call Streamlit or use st.session_state."""
+    start=time.perf_counter()
+    host=SelectBackend(pool,clients,conversation,index['model'])
+    error=None
+    try:
+        EmbedMissing(clients[host],index,texts)
+        logging.getLogger().info(f'Embedded {len(texts)} turns with {index["model"]} in {time.perf_counter()-start:.2f} seconds')
+    except Exception as e:
+        error=e
+        logging.getLogger().warning(f'Embedding turns with {index["model"]} failed: {e}')
+    EndRequest(pool,host,index['model'],error)
+
+# In automatic context mode num_ctx is the smallest of CONTEXT_STEPS that leaves the conversation
+# within CONTEXT_SHARE, so the rest is left for the response. Ollama reloads the model whenever
+# num_ctx changes, so the steps are coarse and the size never shrinks during a conversation.
+CONTEXT_STEPS=(2048,8192,32768,102400)
+
+def AutoContextSize(messages,current,context_length):
+    """ Pick the context token limit for the messages.
+    current is the size used for the previous request, or None for a new conversation.
+    The size is capped at the model's context_length."""
+    tokens=ConversationTokens(messages)
+    size=CONTEXT_STEPS[-1]
+    for step in CONTEXT_STEPS:
+        if tokens<=step*CONTEXT_SHARE:
+            size=step
+            break
+    if current:
+        size=max(size,current)
+    return min(size,context_length)
+
+def ContextReload(metrics,model,num_ctx):
+    """ Ollama reloads a model to change its context size.
+    Compare with the previous response in the conversation to flag the reload in the metrics."""
+    if metrics and metrics[-1]['model']==model and metrics[-1].get('num_ctx')!=num_ctx:
+        return {'num_ctx_reload':True,'previous_num_ctx':metrics[-1].get('num_ctx')}
+    return {'num_ctx_reload':False}
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+""" Ground a chat in attached documents without sending the whole documents.
+An attached document is split into chunks, and each chunk is embedded once with a local Ollama
+embedding model (the vectors are cached on disk, see ChatbotVectors.py). With each question,
+only the DOCUMENT_TOP_K chunks most similar to the question are sent, ahead of the question.
+The chat history keeps the question as it was asked, so the excerpts are only sent once.
+"""
+import re
+import time
+import logging
+import streamlit as st
+
+from ChatbotResidency import (SessionId)
+from ChatbotBackends import (ConversationId,BackendRequest)
+from ChatbotContext import (CountTokens)
+from ChatbotVectors import (
+        VectorIndex,
+        EmbeddingModelSelect,
+        EmbedTexts,
+        EmbedMissing,
+        NearestRows)
+
+# Chunks are at most DOCUMENT_CHUNK_CHARS characters (a few hundred tokens), split at paragraph breaks
+# where possible. Each chunk repeats up to DOCUMENT_CHUNK_OVERLAP characters from the end of the one before,
+# as many as fit in DOCUMENT_CHUNK_CHARS, so a passage split between two chunks is still whole in one of them.
+DOCUMENT_CHUNK_CHARS=1500
+DOCUMENT_CHUNK_OVERLAP=200
+DOCUMENT_TOP_K=4
+DOCUMENT_TYPES=['txt','md','rst','csv','json','py','html','xml','log']
+DOCUMENT_PROMPT='Use these excerpts from the attached documents to answer the question, where they are relevant.\n\n'
+DOCUMENT_QUESTION='\n\nQuestion:\n'
+
+def ChunkText(text,size=DOCUMENT_CHUNK_CHARS,overlap=DOCUMENT_CHUNK_OVERLAP):
+    """ Split text into chunks of at most size characters, at paragraph breaks where possible.
+    Each chunk after the first starts with up to overlap characters from the end of the text before it."""
+    pieces=list()
+    for paragraph in re.split(r'\n\s*\n',text):
+        paragraph=paragraph.strip()
+        # A paragraph longer than a chunk is cut into pieces that already overlap
+        start=0
+        while start<len(paragraph):
+            pieces.append((paragraph[start:start+size],start>0))
+            if start+size>=len(paragraph):
+                break
+            start+=size-overlap
+    chunks=list()
+    current=''
+    for piece,overlapped in pieces:
+        if current and len(current)+len(piece)+2<=size:
+            current+='\n\n'+piece
+            continue
+        if current:
+            chunks.append(current)
+        current=piece
+        # Repeat the end of the chunk before, if there is room and the piece doesn't already overlap it
+        keep=min(overlap,size-len(piece)-2)
+        if chunks and not overlapped and keep>0:
+            current=chunks[-1][-keep:]+'\n\n'+piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def AttachDocument(client,model,name,text):
+    """ Chunk and embed a document. Return the document entry for the chat's documents list."""
+    chunks=ChunkText(text)
+    # Count the chunks rather than the whole document - the chunks are what may be sent
+    chunk_tokens=[CountTokens(chunk) for chunk in chunks]
+    return {'name':name,
+            'chunks':chunks,
+            'chunk_tokens':chunk_tokens,
+            'tokens':sum(chunk_tokens),
+            'model':model,
+            'rows':EmbedMissing(client,VectorIndex(model),chunks)}
+
+def GroundedContext(messages,documents_key,k=DOCUMENT_TOP_K):
+    """ Send the latest question with the chunks of the attached documents in documents_key most similar to it.
+    The embedding requests go to an Ollama host with the embedding model, see ChatbotBackends.py.
+    Return the messages to send and the retrieval details for the metrics:
+    - document_chunks: the number of chunks sent
+    - document_retrieval_seconds: the time to embed the question and find the chunks
+    - document_tokens_saved: the estimated tokens of the documents that were not sent
+    If the question can't be embedded, the messages are sent without excerpts and the error is noted."""
+    start=time.perf_counter()
+    documents=st.session_state[documents_key]
+    model=st.session_state[documents_key+'_model']
+    try:
+        with st.spinner('Finding the relevant parts of the documents...'):
+            index=VectorIndex(model)
+            query,chunks=BackendRequest(ConversationId(SessionId(),documents_key),model,
+                                        lambda client: EmbedQuestion(client,index,documents,messages[-1]['content']))
+            nearest=NearestRows(index,query,k,[row for row,_,_ in chunks])[0]
+    except Exception as e:
+        logging.getLogger().error(f'Document retrieval with {model} failed: {e}')
+        return list(messages),{'document_error':str(e)}
+    # The same text may be in more than one document - send it once, labelled with the first
+    locations=dict()
+    for row,document,i in chunks:
+        locations.setdefault(row,(document,i))
+    excerpts=list()
+    sent_tokens=0
+    for row,_ in nearest:
+        document,i=locations[row]
+        chunk=document['chunks'][i]
+        excerpts.append(f'[{document["name"]}, part {i+1} of {len(document["chunks"])}]\n{chunk}')
+        sent_tokens+=document['chunk_tokens'][i]
+    question=messages[-1]
+    content=DOCUMENT_PROMPT+'\n\n'.join(excerpts)+DOCUMENT_QUESTION+question['content']
+    details={'document_chunks':len(excerpts),
+             'document_retrieval_seconds':time.perf_counter()-start,
+             'document_tokens_saved':max(sum(d['tokens'] for d in documents)-sent_tokens,0)}
+    return list(messages[:-1])+[{'role':question['role'],'content':content}],details
+
+def EmbedQuestion(client,index,documents,question):
+    """ Embed the question, and return its vector and the index row, document, and part number of every chunk.
+    Documents attached with a different embedding model are embedded again with this one."""
+    chunks=list()
+    for document in documents:
+        if document['model']!=index['model']:
+            document['rows']=EmbedMissing(client,index,document['chunks'])
+            document['model']=index['model']
+        chunks+=[(row,document,i) for i,row in enumerate(document['rows'])]
+    return EmbedTexts(client,index['model'],[question]),chunks
+
+def DocumentsPanel(documents_key):
+    """ Attach documents to the chat and choose the embedding model.
+    The attached documents are kept in documents_key and the model in documents_key+'_model'.
+    The uploader is cleared after each attach by changing its key, so removed documents are not attached again."""
+    model_key=documents_key+'_model'
+    upload_key=documents_key+'_upload'
+    if documents_key not in st.session_state:
+        st.session_state[documents_key]=list()
+    documents=st.session_state[documents_key]
+    with st.expander(f'Documents ({len(documents)} attached)',icon=':material/description:'):
+        model=EmbeddingModelSelect(model_key,'Each part of a document is embedded once with this model.')
+        uploads=st.file_uploader(
+                'Attach documents',
+                type=DOCUMENT_TYPES,
+                accept_multiple_files=True,
+                help=f'Only the {DOCUMENT_TOP_K} parts most relevant to each question are sent with it.',
+                key=f'{upload_key}_{st.session_state.get(upload_key,0)}')
+        if uploads:
+            conversation=ConversationId(SessionId(),documents_key)
+            failed=False
+            with st.spinner('Embedding the documents...'):
+                for upload in uploads:
+                    text=upload.read().decode('utf-8',errors='replace')
+                    try:
+                        documents.append(BackendRequest(conversation,model,
+                                                        lambda client: AttachDocument(client,model,upload.name,text)))
+                    except Exception as e:
+                        failed=True
+                        st.error(f'{model} did not embed {upload.name}: {e}',icon=':material/error:')
+            st.session_state[upload_key]=st.session_state.get(upload_key,0)+1
+            # Leave the error shown until the next run
+            if not failed:
+                st.rerun()
+        for document in documents:
+            st.caption(f'{document["name"]} - {len(document["chunks"])} parts, about {document["tokens"]} tokens')
+        if documents and st.button('Remove Documents',help='Remove all the attached documents from this chat'):
+            st.session_state[documents_key]=list()
+            st.rerun()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+""" Model residency - which models Ollama has loaded, who uses them, and what to unload.
+Every response records its host, model, conversation, and time in a process-wide usage registry.
+With a residency budget set, the least recently used models on a host are unloaded before a
+request would take the total size of the models loaded on that host over the budget. Each host
+has its own memory, so the budget applies to each host separately. Models generating a response
+are never unloaded.
+"""
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from ChatbotBackends import (BackendPool,BackendClients)
+
+# The budget is in GB of loaded model size (RAM plus VRAM) as reported by ollama.ps().
+# It applies to each Ollama host. Zero means no budget - Ollama decides when to unload models.
+RESIDENCY_BUDGET_GB=0
+RESIDENCY_POLL_SECONDS=5
+
+@st.cache_resource
+def ResidencyRegistry():
+    """ The process-wide usage registry, shared by every browser session.
+    - conversations: the host, model and last use of each conversation, keyed by session and job key
+    - last_used: the last time each model was sent a request, keyed by (host, model)
+    - active: the number of responses each model is generating, keyed by (host, model)
+    - budget: the residency budget for each host in bytes
+    """
+    return {'conversations':dict(),
+            'last_used':dict(),
+            'active':dict(),
+            'budget':RESIDENCY_BUDGET_GB*1000000000,
+            'lock':threading.Lock()}
+
+def SessionId():
+    """ A short id for this browser session. The sys_ prefix keeps it through the Reset module."""
+    if 'sys_session_id' not in st.session_state:
+        st.session_state['sys_session_id']=uuid.uuid4().hex[:8]
+    return st.session_state['sys_session_id']
+
+def RecordModelUse(registry,conversation,host,model):
+    """ Record that a conversation is starting a response from the model on the host.
+    This is called from the background response thread once the host is picked."""
+    now=time.time()
+    with registry['lock']:
+        registry['conversations'][conversation]={'host':host,'model':model,'last_used':now}
+        registry['last_used'][(host,model)]=now
+        registry['active'][(host,model)]=registry['active'].get((host,model),0)+1
+
+def ReleaseModel(registry,host,model):
+    """ Record that a response is complete. This is called from the background response thread."""
+    with registry['lock']:
+        registry['active'][(host,model)]=max(registry['active'].get((host,model),0)-1,0)
+        registry['last_used'][(host,model)]=time.time()
+
+def UnloadModel(client,model):
+    """ Ask Ollama to unload the model now."""
+    client.generate(model=model,keep_alive=0)
+    logging.getLogger().info(f'Unloaded {model}')
+
+def EnforceBudget(client,registry,host,model=None,model_size=0):
+    """ Unload the least recently used idle models on the host until its loaded models, plus
+    model_size for the model about to be loaded, fit the budget. The model about to be used is kept.
+    This is called from the background response thread before each request, and on each poll."""
+    budget=registry['budget']
+    if not budget:
+        return
+    running=client.ps()['models']
+    total=sum(m['size'] for m in running)
+    if model and model not in [m['model'] for m in running]:
+        total+=model_size
+    with registry['lock']:
+        last_used=dict(registry['last_used'])
+        active=dict(registry['active'])
+    idle=[m for m in running if m['model']!=model and not active.get((host,m['model']))]
+    idle.sort(key=lambda m:last_used.get((host,m['model']),0))
+    for m in idle:
+        if total<=budget:
+            break
+        try:
+            UnloadModel(client,m['model'])
+            total-=m['size']
+        except Exception as e:
+            logging.getLogger().warning(f'Unload of {m["model"]} on {host} failed: {e}')
+
+def ExpiresIn(expires_at):
+    """ Minutes until Ollama unloads a model, from the ollama.ps() expires_at time."""
+    try:
+        expires=datetime.fromisoformat(expires_at)
+    except ValueError:
+        return None
+    minutes=(expires-datetime.now(timezone.utc)).total_seconds()/60
+    # A model kept loaded until Ollama stops expires hundreds of years from now
+    if minutes>60*24*365:
+        return 'never'
+    return round(minutes,1)
+
+def ResidencyModule():
+    """ The model residency module.
+    Show the loaded models on each host and the conversations using them, refreshed every
+    RESIDENCY_POLL_SECONDS. Set the residency budget for the whole server and unload models by hand.
+    """
+    st.markdown('### Model Residency Module')
+    st.divider()
+    registry=ResidencyRegistry()
+    if 'res_budget' not in st.session_state:
+        st.session_state['res_budget']=registry['budget']/1000000000
+    st.number_input(
+            'Residency budget (GB)',
+            min_value=0.0,
+            step=1.0,
+            help='Unload the least recently used models to keep the loaded models under this size. 0 means no budget. This applies to every user of the server.',
+            key='res_budget',
+            on_change=SetBudget,
+            args=[registry])
+    ResidencyView()
+
+def UnloadSelected():
+    """ Unload the model selected in the residency view from its host. As a callback this runs
+    before the view is drawn again, so the table no longer shows the model."""
+    host,model=st.session_state['res_unload_model']
+    try:
+        UnloadModel(BackendClients(BackendPool())[host],model)
+    except Exception as e:
+        st.toast(f'Unload failed: {e}',icon=':material/error:')
+
+def SetBudget(registry):
+    """ Save the budget from the number input in the shared registry."""
+    registry['budget']=st.session_state['res_budget']*1000000000
+
+def PollHost(client,registry,host):
+    """ Apply the budget on the host and return its loaded models, or the error if it did not respond."""
+    try:
+        EnforceBudget(client,registry,host)
+        return client.ps()['models'],None
+    except Exception as e:
+        return list(),e
+
+@st.fragment(run_every=RESIDENCY_POLL_SECONDS)
+def ResidencyView():
+    """ The loaded models table, usage table, and unload controls, polled on an interval."""
+    registry=ResidencyRegistry()
+    clients=BackendClients(BackendPool())
+    # Poll the hosts together, so a host that is down doesn't hold up the others
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        results=dict(zip(clients,executor.map(lambda host: PollHost(clients[host],registry,host),clients)))
+    for host,(running,error) in results.items():
+        if error:
+            st.error(f'Ollama on {host} did not respond: {error}',icon=':material/error:')
+    now=time.time()
+    with registry['lock']:
+        conversations=dict(registry['conversations'])
+        last_used=dict(registry['last_used'])
+        active=dict(registry['active'])
+    rows=list()
+    loaded=list()
+    for host,(running,error) in results.items():
+        for m in running:
+            key=(host,m['model'])
+            users=[k for k,v in conversations.items() if (v['host'],v['model'])==key]
+            loaded.append(key)
+            rows.append({
+                    'Host':host,
+                    'Model':m['model'],
+                    'Size (GB)':round(m['size']/1000000000,2),
+                    'VRAM (GB)':round(m['size_vram']/1000000000,2),
+                    'RAM (GB)':round((m['size']-m['size_vram'])/1000000000,2),
+                    'Unloads in (minutes)':ExpiresIn(m['expires_at']),
+                    'Last used (seconds ago)':round(now-last_used[key]) if key in last_used else None,
+                    'Generating':active.get(key,0),
+                    'Conversations':', '.join(users)})
+    budget=registry['budget']/1000000000
+    for host,(running,error) in results.items():
+        if error:
+            continue
+        total=sum(m['size'] for m in running)/1000000000
+        if budget:
+            st.caption(f'{host}: {len(running)} models loaded, {total:.2f} GB of the {budget:.2f} GB budget')
+        else:
+            st.caption(f'{host}: {len(running)} models loaded, {total:.2f} GB')
+    st.dataframe(rows,hide_index=True,use_container_width=True)
+    unload_cols=st.columns(3,vertical_alignment='bottom')
+    selected=unload_cols[0].selectbox(
+            'Select a model to unload',
+            loaded,
+            format_func=lambda key: f'{key[1]} on {key[0]}' if len(clients)>1 else key[1],
+            key='res_unload_model')
+    unload_cols[1].button(
+            'Unload',
+            help='Unload the model now. It is loaded again by the next request that uses it.',
+            disabled=selected is None,
+            on_click=UnloadSelected,
+            use_container_width=True)
+    st.markdown('**Conversations**')
+    usage=[{'Session':k.split(' ')[0],
+            'Conversation':k.split(' ')[1],
+            'Host':v['host'],
+            'Model':v['model'],
+            'Last used (seconds ago)':round(now-v['last_used'])}
+           for k,v in sorted(conversations.items(),key=lambda kv:kv[1]['last_used'],reverse=True)]
+    st.dataframe(usage,hide_index=True,use_container_width=True)
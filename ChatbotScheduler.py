@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+""" Server-wide scheduling of generation requests.
+Every response and summary from every browser session waits here for one of SCHEDULER_SLOTS
+slots before it is sent to Ollama. Waiting requests are queued by model, and within a model
+each browser session takes its turn, so one busy session can't hold up the others.
+A free slot goes to a model that is generating or has just finished, which is already loaded,
+before other models. The exception is a request that has waited SCHEDULER_MAX_WAIT_SECONDS.
+This groups requests by model and cuts down on model loads and unloads.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+import streamlit as st
+from ChatbotClient import (OLLAMA_HOSTS)
+
+# Ollama generates OLLAMA_NUM_PARALLEL responses at once per model on each host.
+# More requests than that only wait in Ollama's own queue, in no particular order.
+SCHEDULER_SLOTS=int(os.environ.get('OLLAMA_NUM_PARALLEL','4'))*len(OLLAMA_HOSTS)
+SCHEDULER_MAX_WAIT_SECONDS=30
+SCHEDULER_POLL_SECONDS=0.1
+
+@st.cache_resource
+def Scheduler():
+    """ The process-wide scheduler, shared by every browser session.
+    - queues: for each model, the waiting requests of each session in turn order
+    - running: the number of requests each model is generating
+    - last_model: the model of the last request to finish
+    """
+    return {'queues':dict(),
+            'running':dict(),
+            'last_model':None,
+            'slots':SCHEDULER_SLOTS,
+            'lock':threading.Lock()}
+
+def WaitForSlot(scheduler,session,model,cancel):
+    """ Queue a request and wait for a slot. This is called from background threads.
+    Return the seconds waited, or None if the cancel event was set while waiting."""
+    ticket={'model':model,
+            'session':session,
+            'queued':time.monotonic(),
+            'ready':threading.Event()}
+    with scheduler['lock']:
+        sessions=scheduler['queues'].setdefault(model,OrderedDict())
+        sessions.setdefault(session,deque()).append(ticket)
+        Dispatch(scheduler)
+    while not ticket['ready'].wait(SCHEDULER_POLL_SECONDS):
+        if cancel.is_set():
+            with scheduler['lock']:
+                if not ticket['ready'].is_set():
+                    RemoveTicket(scheduler,ticket)
+                    return None
+            # The slot was given out just as the request was cancelled
+            ReleaseSlot(scheduler,model)
+            return None
+    return time.monotonic()-ticket['queued']
+
+def ReleaseSlot(scheduler,model):
+    """ Free the slot of a finished request and give it to the next waiting request."""
+    with scheduler['lock']:
+        scheduler['running'][model]=max(scheduler['running'].get(model,0)-1,0)
+        scheduler['last_model']=model
+        Dispatch(scheduler)
+
+def RemoveTicket(scheduler,ticket):
+    """ Take a cancelled request out of its queue. The caller holds the lock."""
+    sessions=scheduler['queues'][ticket['model']]
+    sessions[ticket['session']].remove(ticket)
+    if not sessions[ticket['session']]:
+        del sessions[ticket['session']]
+
+def Dispatch(scheduler):
+    """ Give the free slots to waiting requests. The caller holds the lock.
+    The model is chosen first, then the next session in turn for that model."""
+    queues=scheduler['queues']
+    running=scheduler['running']
+    now=time.monotonic()
+    while sum(running.values())<scheduler['slots']:
+        waiting=[model for model,sessions in queues.items() if sessions]
+        if not waiting:
+            return
+        def Oldest(model):
+            return min(tickets[0]['queued'] for tickets in queues[model].values())
+        overdue=[model for model in waiting if now-Oldest(model)>SCHEDULER_MAX_WAIT_SECONDS]
+        loaded=[model for model in waiting if running.get(model) or model==scheduler['last_model']]
+        if overdue:
+            model=min(overdue,key=Oldest)
+        elif loaded:
+            model=min(loaded,key=Oldest)
+        else:
+            model=min(waiting,key=Oldest)
+        # Round robin - the session served goes to the back of the line for this model
+        sessions=queues[model]
+        session,tickets=next(iter(sessions.items()))
+        ticket=tickets.popleft()
+        if tickets:
+            sessions.move_to_end(session)
+        else:
+            del sessions[session]
+        running[model]=running.get(model,0)+1
+        ticket['ready'].set()
+
+def QueueLength(scheduler):
+    """ The number of requests waiting for a slot."""
+    with scheduler['lock']:
+        return sum(len(tickets) for sessions in scheduler['queues'].values() for tickets in sessions.values())
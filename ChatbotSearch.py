@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+""" Search every saved chat session for the prompts, responses, and system messages.
+Search by words uses the full-text index in the conversation store (see ChatbotStore.py).
+Search by meaning compares embedding vectors from a local Ollama embedding model (see ChatbotVectors.py),
+so it finds messages about the same thing in other words. The saved messages are embedded in a
+background job the first time, and only new messages after that.
+Each hit can restore its conversation, up to the response to that question, into the chat to carry on from there.
+"""
+import time
+import logging
+import threading
+import streamlit as st
+
+from ChatbotUtilities import (load_key,update_key)
+from ChatbotResidency import (SessionId)
+from ChatbotBackends import (BackendPool,BackendClients,ConversationId,SelectBackend,EndRequest,BackendRequest)
+from ChatbotContext import (CancelSummary)
+from ChatbotStore import (
+        ConversationStore,
+        LoadSession,
+        SearchMessages,
+        MessageHits,
+        MessageCount,
+        MessagesAfter,
+        STORE_SEARCH_LIMIT)
+from ChatbotVectors import (
+        VectorIndex,
+        EmbeddingModelSelect,
+        ContentHash,
+        EmbedTexts,
+        EmbedMissing,
+        NearestRows)
+
+SEARCH_MODES=('Words','Meaning')
+# Saved messages read from the store and embedded at a time by the backfill job
+BACKFILL_MESSAGES=256
+BACKFILL_REFRESH_SECONDS=1
+
+def SearchModule(session,open_chat):
+    """ The search module.
+    session is the session dictionary of the chat that a hit is restored into,
+    and open_chat shows that chat after the restore."""
+    st.markdown('### Search Module')
+    st.divider()
+    if 'srch_mode' not in st.session_state:
+        st.session_state['srch_mode']=SEARCH_MODES[0]
+    load_key('srch_mode')
+    mode=st.radio(
+            'Search by',
+            SEARCH_MODES,
+            horizontal=True,
+            help='Words finds messages with all of the words. Meaning finds messages about the same thing, using an embedding model.',
+            key='_srch_mode',
+            on_change=update_key,
+            args=['srch_mode'])
+    if mode=='Meaning':
+        index=EmbeddingModel()
+    load_key('srch_query')
+    text=st.text_input(
+            'Search all saved chats',
+            placeholder='Enter words to search for',
+            help=f'Shows the best {STORE_SEARCH_LIMIT} matches.',
+            key='_srch_query',
+            on_change=update_key,
+            args=['srch_query'])
+    if not text.strip():
+        return
+    start=time.perf_counter()
+    if mode=='Meaning':
+        try:
+            hits=BackendRequest(ConversationId(SessionId(),'srch_query'),index['model'],
+                                lambda client: SemanticSearch(client,index,text))
+        except Exception as e:
+            st.error(f'{index["model"]} did not embed the search: {e}',icon=':material/error:')
+            return
+    else:
+        hits=SearchMessages(ConversationStore(),text)
+    st.caption(f'Matches: {len(hits)} in {(time.perf_counter()-start)*1000:.1f} milliseconds')
+    ShowHits(session,hits,open_chat)
+
+def EmbeddingModel():
+    """ Select the embedding model, start embedding any new saved messages, and return its vector index."""
+    model=EmbeddingModelSelect('srch_embed_model','Each saved message is embedded once with this model.')
+    index=VectorIndex(model)
+    pool=BackendPool()
+    StartBackfill(pool,BackendClients(pool),ConversationStore(),index)
+    BackfillProgress(index)
+    return index
+
+def StartBackfill(pool,clients,store,index):
+    """ Start embedding the saved messages added since the last backfill, unless one is running."""
+    with index['lock']:
+        backfill=index['backfill']
+        if backfill and backfill['running']:
+            return
+        total=MessageCount(store,index['scanned'])
+        if not total:
+            return
+        index['backfill']={'total':total,
+                           'done':0,
+                           'running':True,
+                           'error':None}
+    threading.Thread(target=BackfillWorker,args=[pool,clients,store,index],daemon=True).start()
+
+def BackfillWorker(pool,clients,store,index):
+    """ Embed the saved messages BACKFILL_MESSAGES at a time and note the messages with each content hash.
+    Each batch goes to a host with the embedding model, see ChatbotBackends.py.
+    A message is only searchable once it is embedded. This runs in a background thread, so it must not call Streamlit."""
+    backfill=index['backfill']
+    start=time.perf_counter()
+    try:
+        while batch:=MessagesAfter(store,index['scanned'],BACKFILL_MESSAGES):
+            messages=[(message_id,content) for message_id,content in batch if content.strip()]
+            host=SelectBackend(pool,clients,ConversationId('backfill',index['model']),index['model'])
+            error=None
+            try:
+                EmbedMissing(clients[host],index,[content for _,content in messages])
+            except Exception as e:
+                error=e
+                raise
+            finally:
+                EndRequest(pool,host,index['model'],error)
+            with index['lock']:
+                for message_id,content in messages:
+                    index['messages'].setdefault(ContentHash(content),list()).append(message_id)
+                index['scanned']=batch[-1][0]
+            backfill['done']=min(backfill['done']+len(batch),backfill['total'])
+        logging.getLogger().info(f'Embedded {backfill["total"]} saved messages with {index["model"]} in {time.perf_counter()-start:.1f} seconds')
+    except Exception as e:
+        backfill['error']=e
+        logging.getLogger().error(f'Embedding saved messages with {index["model"]} failed: {e}')
+    backfill['running']=False
+
+@st.fragment(run_every=BACKFILL_REFRESH_SECONDS)
+def BackfillProgress(index):
+    """ Show the progress of the backfill job. This reruns on its own while the job is running."""
+    backfill=index['backfill']
+    if backfill is None:
+        return
+    if backfill['error']:
+        st.error(f'{index["model"]} did not embed the saved messages: {backfill["error"]}',icon=':material/error:')
+    elif backfill['running']:
+        st.progress(backfill['done']/backfill['total'],
+                    text=f'Embedding saved messages: {backfill["done"]} of {backfill["total"]}')
+    else:
+        st.caption(f'Searching {len(index["messages"])} distinct messages.')
+
+def SemanticSearch(client,index,text,limit=STORE_SEARCH_LIMIT):
+    """ The saved messages most similar in meaning to the text, best first.
+    A message saved many times, such as a system message, may be a hit in several sessions."""
+    query=EmbedTexts(client,index['model'],[text])
+    # The index may also hold other texts embedded with the same model
+    with index['lock']:
+        rows=[index['rows'][h] for h in index['messages']]
+    message_ids=list()
+    scores=dict()
+    for row,score in NearestRows(index,query,limit,rows)[0]:
+        for message_id in reversed(index['messages'].get(index['hashes'][row],list())):
+            message_ids.append(message_id)
+            scores[message_id]=score
+    hits=MessageHits(ConversationStore(),message_ids[:limit])
+    for hit in hits:
+        hit['score']=scores[hit['id']]
+    return hits
+
+def ShowHits(session,hits,open_chat):
+    """ List the search hits, each with a button to restore its conversation."""
+    # A restore while a response is generating would mix the response into the restored chat
+    busy=session['job_key'] in st.session_state
+    if busy:
+        st.caption(':orange[Wait for the response in the chat to finish before restoring a conversation.]')
+    for hit in hits:
+        with st.container(border=True):
+            hit_cols=st.columns([5,1],vertical_alignment='center')
+            heading=f'**{hit["title"] or "(no question)"}** - {hit["updated"]}, {hit["model"] or "no model"}'
+            if 'score' in hit:
+                heading+=f', similarity {hit["score"]:.2f}'
+            hit_cols[0].markdown(heading)
+            hit_cols[0].markdown(f'*{hit["role"]}:* {hit["snippet"]}')
+            if hit_cols[1].button(
+                    'Restore',
+                    help='Restore the conversation up to this point',
+                    key=f'srch_restore_{hit["id"]}',
+                    disabled=busy,
+                    use_container_width=True):
+                RestoreHit(session,hit)
+                open_chat()
+
+def RestoreHit(session,hit):
+    """ Replace the chat with the conversation of a search hit, up to the end of its turn.
+    The restored conversation is saved as a new session with the next response,
+    so the stored session it came from is left as it was."""
+    messages,metrics=LoadSession(ConversationStore(),hit['session_id'],hit['turn_end'])
+    st.session_state[session['messages_key']]=messages
+    st.session_state[session['metrics_key']]=metrics
+    if messages and messages[0]['role']=='system':
+        st.session_state[session['system_key']]=messages[0]['content']
+    for k in (session['session_log_key'],
+              session['metrics_log_key'],
+              session['summary_key'],
+              session['context_key']+'_auto'):
+        if k in st.session_state:
+            del st.session_state[k]
+    CancelSummary(session['summary_key'])
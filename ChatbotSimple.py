@@ -5,8 +5,11 @@ The latest (hopefully working) version should always be available here:
 https://github.com/torchthenet/StreamlitOllamaChatbot
 """
 
+import os
+import logging
 import streamlit as st
 import ollama
+import httpx
 import time
 import json
 
@@ -18,6 +21,31 @@ def load_key(key):
 def update_key(key):
     st.session_state[key]=st.session_state["_"+key]
 
+# One Ollama client per process, shared by every browser session. The client keeps a pool of open
+# HTTP connections, and the pool size limits how many requests are sent to Ollama at once.
+# The host defaults to OLLAMA_HOST in the environment, the same as the ollama package.
+OLLAMA_HOST=os.environ.get('OLLAMA_HOST','http://127.0.0.1:11434')
+OLLAMA_MAX_CONNECTIONS=16
+OLLAMA_KEEPALIVE_CONNECTIONS=8
+OLLAMA_KEEPALIVE_SECONDS=120
+OLLAMA_CONNECT_TIMEOUT=10
+OLLAMA_READ_TIMEOUT=600
+
+@st.cache_resource
+def OllamaClient(host=OLLAMA_HOST):
+    """ The process-wide client for an Ollama host """
+    return ollama.Client(
+            host=host,
+            timeout=httpx.Timeout(
+                    connect=OLLAMA_CONNECT_TIMEOUT,
+                    read=OLLAMA_READ_TIMEOUT,
+                    write=OLLAMA_CONNECT_TIMEOUT,
+                    pool=None),
+            limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OLLAMA_KEEPALIVE_SECONDS))
+
 def StreamData(stream,metrics):
     """ The Ollama generator is not compatible with st.write_stream.
     This wrapper is compatible.
@@ -156,7 +184,7 @@ def GenerateNextResponse():
     st.session_state['cb_messages'].append(message)
     # Get the model response and metrics
     response_metrics='metrics'
-    stream=ollama.chat(
+    stream=OllamaClient().chat(
             model=st.session_state['cb_model'],
             messages=st.session_state['cb_messages'],
             options={'temperature':st.session_state['cb_temperature'],
@@ -178,29 +206,90 @@ def GenerateNextResponse():
     UpdateSessionLogs()
     st.rerun()
 
+# Session and metrics logs are line delimited JSON - one message or metrics record per line.
+# Each update appends only the new records. The files are flushed on every update but only
+# fsync'd to disk every LOG_FSYNC_RECORDS records or LOG_FSYNC_SECONDS seconds.
+LOG_FSYNC_RECORDS=20
+LOG_FSYNC_SECONDS=30.0
+
+@st.cache_resource
+def LogSyncState():
+    """ The records written since the last fsync, and its time, for each log file.
+    This script runs again for every interaction, so the counts are kept once per process
+    rather than in a module variable that each run would reset."""
+    return dict()
+
+def AppendLogRecords(log_file,records):
+    """ Append records to a line delimited JSON log file, creating it if needed.
+    Track the records written since the last fsync for each file and sync in batches."""
+    if not records:
+        return
+    log_fsync_pending=LogSyncState()
+    with open(log_file, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record)+'\n')
+        f.flush()
+        pending,last_sync=log_fsync_pending.get(log_file,(0,time.monotonic()))
+        pending+=len(records)
+        if pending>=LOG_FSYNC_RECORDS or time.monotonic()-last_sync>=LOG_FSYNC_SECONDS:
+            os.fsync(f.fileno())
+            pending,last_sync=0,time.monotonic()
+        log_fsync_pending[log_file]=(pending,last_sync)
+
+def ReadLogRecords(log_file):
+    """ Read the records from an uploaded session or metrics log file.
+    Handles the line delimited format and the older single json.dump list format.
+    Lines that can't be decoded are skipped. Normally this is only a truncated last line
+    left behind by a crash while the record was being written."""
+    text=log_file.read()
+    if isinstance(text,bytes):
+        text=text.decode('utf-8',errors='replace')
+    # Older logs hold one indented JSON list
+    try:
+        records=json.loads(text)
+        if isinstance(records,list):
+            return records
+    except json.JSONDecodeError:
+        pass
+    records=list()
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            logging.getLogger().warning('Skipped unreadable log line: '+line[:80])
+    return records
+
 def UpdateSessionLogs():
-    """ Create or update logs of the prompts, responses, and metrics in the session."""
-    if 'cb_session_log_file' not in st.session_state:
-        # Create new log files if they do not exist.
+    """ Create or append to logs of the prompts, responses, and metrics in the session.
+    Only records added since the last update are written. The system message is written
+    when the log is created; later edits are saved in the system_prompt of each metrics entry."""
+    new_log='cb_session_log_file' not in st.session_state
+    if new_log:
+        # The files are created by the first append.
         now=time.strftime('%Y-%m-%d-%H%M%S')
-        cb_session_log_file=f'ChatbotSession_{now}.log'
-        st.session_state['cb_session_log_file'] = cb_session_log_file
-        cb_metrics_log_file=f'ChatbotSession_{now}_metrics.log'
-        st.session_state['cb_metrics_log_file'] = cb_metrics_log_file
-        with open(cb_session_log_file, 'w') as f:
-            f.write('Chatbot Session Log\n')
-        with open(cb_metrics_log_file, 'w') as f:
-            f.write('Chatbot Metrics Log\n')
-    # Write the current prompt and response to the session log file
-    with open(st.session_state['cb_session_log_file'], 'w') as f:
-        json.dump(st.session_state['cb_messages'], f, indent=4)
-    # Write the current metrics to the metrics log file
-    with open(st.session_state['cb_metrics_log_file'], 'w') as f:
-        json.dump(st.session_state['cb_metrics'], f, indent=4)
+        st.session_state['cb_session_log_file']=f'ChatbotSession_{now}.log'
+        st.session_state['cb_metrics_log_file']=f'ChatbotSession_{now}_metrics.log'
+        st.session_state['cb_session_log_count']=0
+        st.session_state['cb_metrics_log_count']=0
+    # Count only user and assistant messages - the system message may be inserted or removed at any time
+    written=st.session_state['cb_session_log_count']
+    conversation=[msg for msg in st.session_state['cb_messages'] if msg['role']!='system']
+    records=conversation[written:]
+    if new_log:
+        records=[msg for msg in st.session_state['cb_messages'] if msg['role']=='system']+records
+    AppendLogRecords(st.session_state['cb_session_log_file'],records)
+    st.session_state['cb_session_log_count']=len(conversation)
+    # Append the new metrics to the metrics log file
+    written=st.session_state['cb_metrics_log_count']
+    AppendLogRecords(st.session_state['cb_metrics_log_file'],st.session_state['cb_metrics'][written:])
+    st.session_state['cb_metrics_log_count']=len(st.session_state['cb_metrics'])
 
 def RestoreSessionLogs():
     """ Restore the session and metrics lists from user provided log files.
-    There is no check to see if the files are valid. """
+    There is no check to see if the files are valid, but a truncated last line is ignored.
+    The restored session is written to new log files with the next response. """
     st.markdown('### Restore Session Logs')
     st.divider()
     st.markdown('Upload the session log file (ChatbotSession_*.log) and the metrics log file (ChatbotSession_*_metrics.log)')
@@ -219,9 +308,13 @@ def RestoreSessionLogs():
             label_visibility='collapsed')
     if session_log_file and metrics_log_file:
         # Read the session log file and restore the messages list
-        st.session_state['cb_messages']=json.load(session_log_file)
+        st.session_state['cb_messages']=ReadLogRecords(session_log_file)
         # Read the metrics log file and restore the metrics list
-        st.session_state['cb_metrics']=json.load(metrics_log_file)
+        st.session_state['cb_metrics']=ReadLogRecords(metrics_log_file)
+        # Start new log files so the restored history is included in full
+        for k in ('cb_session_log_file','cb_metrics_log_file'):
+            if k in st.session_state:
+                del st.session_state[k]
         st.write('Session restored.')
 
 def ChatbotModule():
@@ -335,20 +428,20 @@ def ShowModel():
     """ Show current model """
     st.write('### Show Current Model')
     st.write('Model: '+st.session_state['cb_model'])
-    model_info=ollama.show(st.session_state['cb_model'])
+    model_info=OllamaClient().show(st.session_state['cb_model'])
     st.write(model_info)
 
 def ListModels():
     """ Show all available models """
     st.write('### List Available Models')
-    model_list=ollama.list()
+    model_list=OllamaClient().list()
     st.write(model_list)
     return
 
 def ShowRunningModels():
     """ Display models currently active in ollama """
     st.write('### Show Running Models')
-    running_list=ollama.ps()
+    running_list=OllamaClient().ps()
     st.write(running_list)
 
 def ResetModule():
@@ -384,7 +477,7 @@ def InventoryModels():
     Selected details are included in every metrics summary displayed to the user.
     The max context length is used to set the slider max_value."""
     st.session_state['sys_models']=dict()
-    for model in ollama.list()['models']:
+    for model in OllamaClient().list()['models']:
         try:
             del model_vision_embedding_length
         except NameError:
@@ -395,7 +488,7 @@ def InventoryModels():
             pass
         model_name=model['model']
         model_parameter_size=model['details']['parameter_size']
-        model_info=ollama.show(model['model'])
+        model_info=OllamaClient().show(model['model'])
         try:
             model_system_prompt=model_info['system']
         except KeyError:
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+""" The conversation store - one SQLite database for every chat session.
+Each session has a row in sessions, and its messages and metrics records are rows in messages
+and metrics, in the order they were written. Each update inserts only the new rows.
+The database uses write-ahead logging, so the restore picker can read while a response is saved.
+The old ChatbotSession_*.log file pairs can be imported in bulk.
+Every message is also added to a full-text index (SQLite FTS5) by a trigger, in the same
+transaction that inserts it, so the search is always up to date.
+"""
+import os
+import json
+import glob
+import time
+import logging
+import sqlite3
+import threading
+import streamlit as st
+
+STORE_FILE='ChatbotStore.db'
+STORE_LIST_LIMIT=200
+STORE_SEARCH_LIMIT=50
+
+STORE_SCHEMA="""
+CREATE TABLE IF NOT EXISTS sessions(
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    model TEXT NOT NULL DEFAULT '',
+    message_count INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(updated);
+CREATE TABLE IF NOT EXISTS messages(
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    role TEXT NOT NULL,
+    content TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS messages_session ON messages(session_id,id);
+CREATE TABLE IF NOT EXISTS metrics(
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    record TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS metrics_session ON metrics(session_id,id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content,
+    content='messages',
+    content_rowid='id',
+    tokenize='porter unicode61');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid,content) VALUES(new.id,new.content);
+END;
+"""
+
+@st.cache_resource
+def ConversationStore():
+    """ The process-wide store connection, shared by every browser session.
+    Streamlit runs each script run in its own thread, so the connection is shared across
+    threads and each use holds the lock."""
+    db=sqlite3.connect(STORE_FILE,check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    # With WAL, NORMAL only syncs at checkpoints. A crash can lose the last few turns but not corrupt the store.
+    db.execute('PRAGMA synchronous=NORMAL')
+    new_index=db.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone() is None
+    db.executescript(STORE_SCHEMA)
+    if new_index:
+        # A store from before the search index - index the messages already saved
+        with db:
+            db.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+    return {'db':db,'lock':threading.Lock()}
+
+def Now():
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+def CreateSession(store,name):
+    """ Add a session and return its id."""
+    with store['lock'], store['db'] as db:
+        cursor=db.execute('INSERT INTO sessions(name,created,updated) VALUES(?,?,?)',(name,Now(),Now()))
+    return cursor.lastrowid
+
+def AppendSessionRecords(store,session_id,messages,metrics):
+    """ Insert new message and metrics records for a session in one transaction.
+    The session title is the first question, and the model is from the latest metrics."""
+    with store['lock'], store['db'] as db:
+        db.executemany('INSERT INTO messages(session_id,role,content) VALUES(?,?,?)',
+                       [(session_id,msg['role'],msg['content']) for msg in messages])
+        db.executemany('INSERT INTO metrics(session_id,record) VALUES(?,?)',
+                       [(session_id,json.dumps(record)) for record in metrics])
+        db.execute('UPDATE sessions SET updated=?,message_count=message_count+? WHERE id=?',
+                   (Now(),len(messages),session_id))
+        questions=[msg['content'] for msg in messages if msg['role']=='user']
+        if questions:
+            db.execute("UPDATE sessions SET title=? WHERE id=? AND title=''",(questions[0][:100],session_id))
+        if metrics:
+            db.execute('UPDATE sessions SET model=? WHERE id=?',(metrics[-1].get('model',''),session_id))
+
+def ListSessions(store,limit=STORE_LIST_LIMIT):
+    """ The most recently updated sessions, newest first."""
+    with store['lock']:
+        rows=store['db'].execute(
+                'SELECT id,name,updated,title,model,message_count FROM sessions ORDER BY updated DESC LIMIT ?',
+                (limit,)).fetchall()
+    return [dict(zip(('id','name','updated','title','model','message_count'),row)) for row in rows]
+
+def LoadSession(store,session_id,last_message_id=None):
+    """ Return the messages and metrics lists of a session.
+    With last_message_id, only the conversation up to and including that message is returned,
+    with the metrics of the responses in it."""
+    with store['lock']:
+        db=store['db']
+        if last_message_id is None:
+            rows=db.execute('SELECT role,content FROM messages WHERE session_id=? ORDER BY id',(session_id,)).fetchall()
+        else:
+            rows=db.execute('SELECT role,content FROM messages WHERE session_id=? AND id<=? ORDER BY id',
+                            (session_id,last_message_id)).fetchall()
+        records=db.execute('SELECT record FROM metrics WHERE session_id=? ORDER BY id',(session_id,)).fetchall()
+    messages=[{'role':role,'content':content} for role,content in rows]
+    responses=sum(1 for msg in messages if msg['role']=='assistant')
+    metrics=[json.loads(record) for (record,) in records][:responses]
+    return messages,metrics
+
+# The columns of a search hit after the message id, role, and snippet - the session, and turn_end,
+# the id of the response that ends the turn of the message, to restore the conversation to
+HIT_COLUMNS="""s.id,s.name,s.updated,s.title,s.model,
+               COALESCE((SELECT MIN(a.id) FROM messages a
+                         WHERE a.session_id=m.session_id AND a.id>=m.id AND a.role='assistant'),m.id)"""
+HIT_KEYS=('id','role','snippet','session_id','name','updated','title','model','turn_end')
+
+def SearchQuery(text):
+    """ Turn the search text into an FTS5 query that finds messages with all of the words.
+    Each word is quoted so punctuation and FTS5 operators in the text are searched for as typed."""
+    return ' '.join('"'+word.replace('"','""')+'"' for word in text.split())
+
+def SearchMessages(store,text,limit=STORE_SEARCH_LIMIT):
+    """ Search every stored message for the words in text, best matches first.
+    Each hit has the message id, role, and a snippet with the words in bold, its session,
+    and turn_end (see HIT_COLUMNS)."""
+    query=SearchQuery(text)
+    if not query:
+        return list()
+    with store['lock']:
+        rows=store['db'].execute(
+                f"""SELECT m.id,m.role,snippet(messages_fts,0,'**','**','...',24),{HIT_COLUMNS}
+                    FROM messages_fts
+                    JOIN messages m ON m.id=messages_fts.rowid
+                    JOIN sessions s ON s.id=m.session_id
+                    WHERE messages_fts MATCH ?
+                    ORDER BY rank LIMIT ?""",
+                (query,limit)).fetchall()
+    return [dict(zip(HIT_KEYS,row)) for row in rows]
+
+def MessageHits(store,message_ids,snippet_length=300):
+    """ The messages with these ids as search hits, like SearchMessages, in the same order.
+    The snippet is the start of the message."""
+    if not message_ids:
+        return list()
+    with store['lock']:
+        rows=store['db'].execute(
+                f"""SELECT m.id,m.role,substr(m.content,1,?),{HIT_COLUMNS}
+                    FROM messages m
+                    JOIN sessions s ON s.id=m.session_id
+                    WHERE m.id IN ({','.join('?'*len(message_ids))})""",
+                (snippet_length,*message_ids)).fetchall()
+    hits={row[0]:dict(zip(HIT_KEYS,row)) for row in rows}
+    return [hits[message_id] for message_id in message_ids if message_id in hits]
+
+def MessageCount(store,message_id=0):
+    """ The number of stored messages after message_id."""
+    with store['lock']:
+        return store['db'].execute('SELECT COUNT(*) FROM messages WHERE id>?',(message_id,)).fetchone()[0]
+
+def MessagesAfter(store,message_id,limit=None):
+    """ The id and content of the stored messages after message_id, oldest first."""
+    with store['lock']:
+        return store['db'].execute('SELECT id,content FROM messages WHERE id>? ORDER BY id LIMIT ?',
+                                   (message_id,-1 if limit is None else limit)).fetchall()
+
+def ReadLogRecords(log_file):
+    """ Read the records from a session or metrics log file (a path or an uploaded file).
+    Handles the line delimited format and the older single json.dump list format.
+    Lines that can't be decoded are skipped. Normally this is only a truncated last line
+    left behind by a crash while the record was being written."""
+    if isinstance(log_file,str):
+        with open(log_file, 'r', encoding='utf-8') as f:
+            text=f.read()
+    else:
+        text=log_file.read()
+    if isinstance(text,bytes):
+        text=text.decode('utf-8',errors='replace')
+    # Older logs hold one indented JSON list
+    try:
+        records=json.loads(text)
+        if isinstance(records,list):
+            return records
+    except json.JSONDecodeError:
+        pass
+    records=list()
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            logging.getLogger().warning('Skipped unreadable log line: '+line[:80])
+    return records
+
+def ImportLogPair(store,name,session_file,metrics_file):
+    """ Import a session log and its metrics log as a new session.
+    Return the session id, or None if a session with that name was imported before."""
+    messages=ReadLogRecords(session_file)
+    metrics=ReadLogRecords(metrics_file)
+    try:
+        session_id=CreateSession(store,name)
+    except sqlite3.IntegrityError:
+        return None
+    AppendSessionRecords(store,session_id,messages,metrics)
+    # Keep the time in the log file name so imported sessions are listed in order
+    try:
+        logged=time.strftime('%Y-%m-%d %H:%M:%S',time.strptime(name[15:32],'%Y-%m-%d-%H%M%S'))
+        with store['lock'], store['db'] as db:
+            db.execute('UPDATE sessions SET created=?,updated=? WHERE id=?',(logged,logged,session_id))
+    except ValueError:
+        pass
+    return session_id
+
+def ImportLogFiles(store,directory='.'):
+    """ Import every ChatbotSession_*.log and ChatbotSession_*_metrics.log pair in the directory.
+    Pairs imported before are skipped. Return the number imported and the number skipped."""
+    imported=0
+    skipped=0
+    for session_file in sorted(glob.glob(os.path.join(directory,'ChatbotSession_*.log'))):
+        if session_file.endswith('_metrics.log'):
+            continue
+        metrics_file=session_file[:-4]+'_metrics.log'
+        if not os.path.exists(metrics_file):
+            skipped+=1
+            continue
+        name=os.path.basename(session_file)[:-4]
+        try:
+            if ImportLogPair(store,name,session_file,metrics_file) is None:
+                skipped+=1
+            else:
+                imported+=1
+        except (OSError, UnicodeDecodeError) as e:
+            logging.getLogger().warning(f'Import of {session_file} failed: {e}')
+            skipped+=1
+    return imported,skipped
@@ -9,9 +9,35 @@ import os
 import logging
 import streamlit as st
 import ollama
+import httpx
 import time
 
 
+# One Ollama client per process, shared by every browser session. The client keeps a pool of open
+# HTTP connections, and the pool size limits how many requests are sent to Ollama at once.
+# The host defaults to OLLAMA_HOST in the environment, the same as the ollama package.
+OLLAMA_HOST=os.environ.get('OLLAMA_HOST','http://127.0.0.1:11434')
+OLLAMA_MAX_CONNECTIONS=16
+OLLAMA_KEEPALIVE_CONNECTIONS=8
+OLLAMA_KEEPALIVE_SECONDS=120
+OLLAMA_CONNECT_TIMEOUT=10
+OLLAMA_READ_TIMEOUT=600
+
+@st.cache_resource
+def OllamaClient(host=OLLAMA_HOST):
+    """ The process-wide client for an Ollama host """
+    return ollama.Client(
+            host=host,
+            timeout=httpx.Timeout(
+                    connect=OLLAMA_CONNECT_TIMEOUT,
+                    read=OLLAMA_READ_TIMEOUT,
+                    write=OLLAMA_CONNECT_TIMEOUT,
+                    pool=None),
+            limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OLLAMA_KEEPALIVE_SECONDS))
+
 def StreamData(stream):
     """ The Ollama generator is not compatible with st.write_stream
     This wrapper is compatible.
@@ -135,7 +161,7 @@ def GenerateNextResponse(messages_key,metrics_key,prompt_key,temperature_key,mod
              'content':st.session_state[prompt_key]
             }
     st.session_state[messages_key].append(message)
-    stream=ollama.chat(
+    stream=OllamaClient().chat(
             model=st.session_state[model_key],
             messages=st.session_state[messages_key],
             options={'temperature':st.session_state[temperature_key]},
@@ -304,7 +330,7 @@ def ShowModel():
                     expanded=False,
                     icon=':material/stylus:'):
             if model in st.session_state:
-                model_info=ollama.show(st.session_state[model])
+                model_info=OllamaClient().show(st.session_state[model])
             else:
                 model_info=f'{model} has not been selected yet.'
             st.write(model_info)
@@ -312,7 +338,7 @@ def ShowModel():
 def ListModels():
     """ Show all available models """
     st.write('### List Available Models')
-    model_list=ollama.list()['models']
+    model_list=OllamaClient().list()['models']
     for model in model_list:
         with st.expander(
                     label=f'Model {model['model']}',
@@ -323,7 +349,7 @@ def ListModels():
 def ShowRunningModels():
     """ Display models currently active in ollama """
     st.write('### Show Running Models')
-    running_list=ollama.ps()
+    running_list=OllamaClient().ps()
     st.write(running_list)
 
 def ResetModule():
@@ -385,7 +411,7 @@ if __name__=='__main__':
         st.session_state['log']=logging.getLogger()
         InitializeLogging()
     # Load list of models
-    model_dictionary=ollama.list()
+    model_dictionary=OllamaClient().list()
     model_list=list()
     for m in model_dictionary['models']:
         model_list.append(m['model'])
@@ -4,9 +4,26 @@
 import os
 import logging
 import streamlit as st
-import ollama
+from streamlit.errors import StreamlitAPIException
 import time
 import json
+import threading
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from ChatbotClient import (OllamaClient)
+from ChatbotCache import (LookupResponse,StoreResponse)
+from ChatbotResidency import (SessionId,ResidencyRegistry,RecordModelUse,ReleaseModel,EnforceBudget)
+from ChatbotBackends import (BackendPool,BackendClients,ConversationId,SelectBackend,EndRequest,HedgedChat,HEDGE_DELAY_SECONDS)
+from ChatbotScheduler import (Scheduler,WaitForSlot,ReleaseSlot,QueueLength)
+from ChatbotStore import (
+        ConversationStore,
+        CreateSession,
+        AppendSessionRecords,
+        ListSessions,
+        LoadSession,
+        ImportLogPair,
+        ImportLogFiles,
+        STORE_LIST_LIMIT)
 
 # Enable persistent values
 # https://docs.streamlit.io/develop/concepts/architecture/widget-behavior#widgets-do-not-persist-when-not-continually-rendered
@@ -16,33 +33,319 @@ def load_key(key):
 def update_key(key):
     st.session_state[key]=st.session_state['_'+key]
 
-def StreamData(stream,metrics,temperature_key,context_key,system_key):
-    """ The Ollama generator is not compatible with st.write_stream.
-    This wrapper is compatible.
-    The final response returns the metrics, which are saved in a dictionary.
+def RerunFragment():
+    """ Rerun only the fragment that is running, or the whole app if this is a full script run.
+    Streamlit only allows st.rerun(scope='fragment') during a fragment rerun."""
+    try:
+        st.rerun(scope='fragment')
+    except StreamlitAPIException:
+        st.rerun()
+
+def LogRunTime(label,start):
+    """ Log the time since start (from time.perf_counter) for a script or fragment run."""
+    logging.getLogger().info(f'{label} run time = {time.perf_counter()-start:.3f} seconds')
+
+def Percentile(values,fraction):
+    """ Nearest-rank percentile of a list of numbers, or None for an empty list."""
+    if not values:
+        return None
+    ordered=sorted(values)
+    return ordered[min(int(fraction*len(ordered)),len(ordered)-1)]
+
+def StreamTimings(send_start,chunk_times,final_chunk):
+    """ Latency metrics for one response, from the arrival time of each chunk and the durations
+    Ollama reports in the final chunk. Times are in seconds and rates in tokens per second.
+    - ttft: time to first token, measured from when the request is sent, after any wait for the scheduler
+    - itl_p50, itl_p99: median and 99th percentile gap between tokens
+    - prompt_eval_rate, eval_rate: prompt processing and generation rates
+    - load_seconds: time Ollama spent loading the model
     """
-    for chunk in stream:
-        if chunk['done']:
-            st.session_state[metrics]=chunk.copy()
-            st.session_state[metrics]['temperature']=st.session_state[temperature_key]
-            st.session_state[metrics]['num_ctx']=st.session_state[context_key]
-            model=st.session_state[metrics]['model']
-            st.session_state[metrics]['parameter_size']=st.session_state['sys_models'][model]['parameter_size']
-            st.session_state[metrics]['quantization_level']=st.session_state['sys_models'][model]['quantization_level']
-            st.session_state[metrics]['context_length']=st.session_state['sys_models'][model]['context_length']
-            st.session_state[metrics]['embedding_length']=st.session_state['sys_models'][model]['embedding_length']
-            st.session_state[metrics]['system_prompt']=st.session_state[system_key]
+    gaps=[later-earlier for earlier,later in zip(chunk_times,chunk_times[1:])]
+    prompt_eval_seconds=final_chunk.get('prompt_eval_duration',0)/1000000000
+    eval_seconds=final_chunk.get('eval_duration',0)/1000000000
+    timings={
+            'ttft':chunk_times[0]-send_start if chunk_times else None,
+            'itl_p50':Percentile(gaps,0.50),
+            'itl_p99':Percentile(gaps,0.99),
+            'prompt_eval_rate':final_chunk.get('prompt_eval_count',0)/prompt_eval_seconds if prompt_eval_seconds else None,
+            'eval_rate':final_chunk.get('eval_count',0)/eval_seconds if eval_seconds else None,
+            'load_seconds':final_chunk.get('load_duration',0)/1000000000
+            }
+    return timings
+
+# Responses are generated in a background thread, one job per conversation. The thread buffers the
+# response in a job dictionary kept in st.session_state, so the response survives when the script
+# run is interrupted by a page switch. Showing the page again attaches to the same job.
+# The job dictionary is shared with the thread. The thread only appends to its lists and sets
+# metrics and error before it sets done. The Stop button sets the cancel event, and the thread
+# closes the HTTP stream at the next chunk, which makes Ollama stop generating the response.
+
+def ModelDetails(model,temperature,num_ctx,system_prompt):
+    """ Settings and model features saved with the metrics of every response."""
+    details={'temperature':temperature,
+             'num_ctx':num_ctx,
+             'system_prompt':system_prompt}
+    for k in ('parameter_size','quantization_level','context_length','embedding_length'):
+        details[k]=st.session_state['sys_models'][model][k]
+    return details
+
+def StartResponse(job_key,model,messages,options,details,cache_key=None,keep_alive=None):
+    """ Start generating a response in a background thread and save the job in st.session_state[job_key].
+    The details are added to the metrics when the response is complete.
+    With a cache key, a cached response is replayed instead, and a new response is added to the cache.
+    keep_alive is how long Ollama keeps the model loaded after the response, or None for the Ollama default."""
+    job={'model':model,
+         'chunks':list(),
+         'chunk_times':list(),
+         'request_start':time.perf_counter(),
+         'send_start':None,
+         'details':details,
+         'stream_cpu_seconds':0.0,
+         'metrics':None,
+         'error':None,
+         'cancel':threading.Event(),
+         'cache_key':cache_key,
+         'keep_alive':keep_alive,
+         'model_size':st.session_state['sys_models'][model].get('size',0),
+         'residency':ResidencyRegistry(),
+         'done':False}
+    st.session_state[job_key]=job
+    if cache_key:
+        cached=LookupResponse(cache_key)
+        if cached:
+            # The job is complete as soon as it starts, so the response streams straight from the buffer
+            job['chunks']=list(cached['chunks'])
+            job['send_start']=job['request_start']
+            job['chunk_times']=[job['request_start']]*len(job['chunks'])
+            job['metrics']=dict(cached['metrics'])
+            job['metrics'].update(details)
+            job['metrics']['cache_hit']=True
+            job['done']=True
+            return
+    # The request waits for its turn in the server-wide scheduler, see ChatbotScheduler.py
+    job['scheduler']=Scheduler()
+    job['session']=SessionId()
+    job['queued']=True
+    # Then it goes to the least loaded Ollama host with the model, see ChatbotBackends.py
+    job['backends']=BackendPool()
+    job['clients']=BackendClients(job['backends'])
+    job['conversation']=ConversationId(job['session'],job_key)
+    # In Hedged Requests mode a slow response is also requested from a second host
+    job['hedge']=st.session_state.get('hedge_mode',False) and len(job['backends']['hosts'])>1
+    if job['hedge']:
+        details['hedged']=False
+        details['hedge_won']=False
+    # Pass a copy of the messages - the conversation may change while the response is generated
+    threading.Thread(target=ResponseWorker,args=[job,list(messages),options],daemon=True).start()
+
+def ResponseWorker(job,messages,options):
+    """ Wait for a turn from the scheduler, then pick the host and generate the response.
+    This runs in a background thread, so it must not call Streamlit or use st.session_state."""
+    job['details']['queue_wait']=WaitForSlot(job['scheduler'],job['session'],job['model'],job['cancel'])
+    # The latency metrics are measured from here, so the queue wait is only counted in queue_wait
+    job['send_start']=time.perf_counter()
+    job['queued']=False
+    if job['details']['queue_wait'] is None:
+        # Stopped while waiting - nothing was sent to Ollama
+        job['metrics']=CancelledMetrics(job)
+        job['done']=True
+        return
+    try:
+        job['host']=SelectBackend(job['backends'],job['clients'],job['conversation'],job['model'])
+        job['client']=job['clients'][job['host']]
+        job['details']['host']=job['host']
+        StreamResponse(job,messages,options)
+    except Exception as e:
+        # StreamResponse reports its own errors, so this failed before the request was sent.
+        # Finish the job anyway, or FollowResponse would wait for it forever.
+        logging.getLogger().error(f'Response from {job["model"]} could not be sent: {e}')
+        job['error']=str(e)
+    finally:
+        ReleaseSlot(job['scheduler'],job['model'])
+        job['done']=True
+
+def StreamResponse(job,messages,options):
+    """ Generate a response from the job's host and buffer it in the job.
+    Before the request, idle models on the host are unloaded if needed to keep within the residency budget."""
+    error=None
+    racing=False
+    RecordModelUse(job['residency'],job['conversation'],job['host'],job['model'])
+    try:
+        EnforceBudget(job['client'],job['residency'],job['host'],job['model'],job['model_size'])
+        if job['hedge']:
+            # Each hedged request ends its own in-flight count
+            stream=HedgedChat(job,messages,options)
+            racing=True
         else:
-            yield chunk['message']['content']
+            stream=job['client'].chat(
+                    model=job['model'],
+                    messages=messages,
+                    options=options,
+                    keep_alive=job['keep_alive'],
+                    stream=True)
+        for chunk in stream:
+            if job['cancel'].is_set():
+                stream.close()
+                job['metrics']=CancelledMetrics(job)
+                logging.getLogger().info(f'Response from {job["model"]} stopped after {len(job["chunks"])} tokens')
+                break
+            if chunk['done']:
+                metrics=chunk.copy()
+                metrics.update(job['details'])
+                metrics.update(StreamTimings(job['send_start'],job['chunk_times'],chunk))
+                job['metrics']=metrics
+                if job['cache_key']:
+                    StoreResponse(job['cache_key'],job['chunks'],metrics)
+            else:
+                job['chunk_times'].append(time.perf_counter())
+                job['chunks'].append(chunk['message']['content'])
+    except Exception as e:
+        logging.getLogger().error(f'Response from {job["model"]} on {job["host"]} failed: {e}')
+        job['error']=str(e)
+        error=e
+    ReleaseModel(job['residency'],job['host'],job['model'])
+    if not racing:
+        EndRequest(job['backends'],job['host'],job['model'],error)
+    job['done']=True
+
+def CancelResponse(job_key):
+    """ Stop the response being generated for a conversation that is cleared, and forget it.
+    Deleting the job alone would leave its thread streaming from Ollama, holding its scheduler slot
+    and its count on the backend host, into a job that nothing reads."""
+    if job_key in st.session_state:
+        st.session_state[job_key]['cancel'].set()
+        del st.session_state[job_key]
+
+def CancelledMetrics(job):
+    """ Metrics for a response stopped by the user. Ollama never sends the final chunk,
+    so the durations are measured here and the response tokens are counted from the chunks received."""
+    metrics={'model':job['model'],
+             'done':True,
+             'done_reason':'cancelled',
+             'cancelled':True,
+             'total_duration':int((time.perf_counter()-job['send_start'])*1000000000),
+             'prompt_eval_count':None,
+             'eval_count':len(job['chunks'])}
+    metrics.update(job['details'])
+    metrics.update(StreamTimings(job['send_start'],job['chunk_times'],dict()))
+    return metrics
+
+def IncompleteMetrics(job):
+    """ Metrics for a response whose stream ended without Ollama's final chunk and without an error.
+    They are measured here, like the metrics of a stopped response."""
+    metrics=CancelledMetrics(job)
+    metrics['cancelled']=False
+    metrics['done_reason']='incomplete'
+    return metrics
+
+# st.write_stream re-renders the whole growing response for every piece of text it receives.
+# StreamData collects the tokens and passes them on every STREAM_FLUSH_SECONDS or STREAM_FLUSH_CHARS,
+# whichever comes first. Turn off the Batched Streaming toggle to pass on new text every STREAM_POLL_SECONDS.
+STREAM_FLUSH_SECONDS=0.05
+STREAM_FLUSH_CHARS=64
+STREAM_POLL_SECONDS=0.01
+
+def StreamData(job,status=None):
+    """ Follow a response job for st.write_stream. Everything buffered so far is passed on first,
+    then new text as it arrives, until the response is complete.
+    The CPU time of the script thread while streaming is added to the job to measure the cost of rendering.
+    thread_time leaves out the other sessions and the background response threads, which process_time counts.
+    If a status placeholder is provided it shows the live token count and rate.
+    """
+    batch_mode=st.session_state.get('batch_mode',True)
+    cpu_start=time.thread_time()
+    sent=0
+    last_flush=time.monotonic()
+    last_status=0.0
+    while True:
+        # Check done before counting the chunks so no text added at the end is missed
+        done=job['done']
+        available=len(job['chunks'])
+        if available>sent:
+            pending=''.join(job['chunks'][sent:available])
+            if done or not batch_mode or len(pending)>=STREAM_FLUSH_CHARS or time.monotonic()-last_flush>=STREAM_FLUSH_SECONDS:
+                yield pending
+                sent=available
+                last_flush=time.monotonic()
+        if done:
+            break
+        # Update the status a few times a second. This also lets Streamlit interrupt the run
+        # for a page switch while waiting for the first token.
+        if status and time.monotonic()-last_status>=0.5:
+            last_status=time.monotonic()
+            chunk_times=job['chunk_times'][:available]
+            if len(chunk_times)>1:
+                rate=(len(chunk_times)-1)/(chunk_times[-1]-chunk_times[0])
+                status.caption(f'{len(chunk_times)} tokens, {rate:.1f} tokens/second')
+            elif job.get('queued'):
+                status.caption(f'Waiting for a turn - {QueueLength(job["scheduler"])} requests queued ({time.perf_counter()-job["request_start"]:.1f} seconds)')
+            else:
+                status.caption(f'Waiting for the first token ({time.perf_counter()-(job["send_start"] or job["request_start"]):.1f} seconds)')
+        time.sleep(STREAM_POLL_SECONDS)
+    if status:
+        status.empty()
+    job['stream_cpu_seconds']+=time.thread_time()-cpu_start
+
+def FollowResponse(job_key):
+    """ Show the response being generated for a conversation as it streams and wait until it is complete.
+    The Stop button cancels the response; the text received so far is kept.
+    A response that ends without metrics or an error gets measured metrics, so the history can always show them.
+    Add the batch mode and streaming CPU time to the metrics and return the job."""
+    job=st.session_state[job_key]
+    if not job['done']:
+        st.button(
+                'Stop',
+                help='Stop generating this response and keep the text received so far',
+                key=job_key+'_stop',
+                icon=':material/stop_circle:',
+                on_click=job['cancel'].set)
+    with st.expander(
+                label='Response',
+                expanded=True,
+                icon=':material/smart_toy:'):
+        status=st.empty()
+        st.write_stream(StreamData(job,status))
+    if job['metrics'] is None and not job['error']:
+        job['metrics']=IncompleteMetrics(job)
+    if job['metrics']:
+        job['metrics']['batch_mode']=st.session_state.get('batch_mode',True)
+        job['metrics']['stream_cpu_seconds']=job['stream_cpu_seconds']
+    return job
+
+def FormatMetric(value,digits,scale=1):
+    """ Format an optional metric value for display. Missing values are shown as n/a."""
+    if value is None:
+        return 'n/a'
+    return str(round(value*scale,digits))
 
 def DisplayMetrics(metrics):
     """ Display formatted Ollama metrics and message data to the user.
     """
     metrics_string='Model: '+metrics['model']
+    if 'host' in metrics:
+        metrics_string+='\nOllama host = '+metrics['host']
     metrics_string+='\nParameter size = '+str(metrics['parameter_size'])
     metrics_string+='\nQuantization level = '+str(metrics['quantization_level'])
     metrics_string+='\nContext tokens used = '+str(metrics['prompt_eval_count'])
     metrics_string+='\nContext token limit = '+str(metrics['num_ctx'])
+    if metrics.get('num_ctx_reload'):
+        metrics_string+='\nModel reloaded to change the context token limit from '+str(metrics['previous_num_ctx'])
+    if metrics.get('context_summarized_messages'):
+        metrics_string+='\nEarlier messages sent as a summary = '+str(metrics['context_summarized_messages'])
+    if metrics.get('context_dropped_messages'):
+        metrics_string+='\nEarlier messages not sent = '+str(metrics['context_dropped_messages'])+' (about '+str(metrics['context_dropped_tokens'])+' tokens)'
+    if metrics.get('memory_turns_recalled') is not None:
+        metrics_string+='\nEarlier turns recalled = '+str(metrics['memory_turns_recalled'])+' ('+str(metrics['memory_turns_skipped'])+' not sent)'
+        if metrics.get('memory_turns_pending'):
+            metrics_string+='\nEarlier turns sent while they are embedded = '+str(metrics['memory_turns_pending'])
+        metrics_string+='\nMemory retrieval time (seconds) = '+FormatMetric(metrics['memory_retrieval_seconds'],3)
+    if metrics.get('memory_error'):
+        metrics_string+='\nMemory not used, all turns sent: '+metrics['memory_error']
+    if metrics.get('document_chunks') is not None:
+        metrics_string+='\nDocument parts sent = '+str(metrics['document_chunks'])+' (about '+str(metrics['document_tokens_saved'])+' document tokens not sent)'
+        metrics_string+='\nDocument retrieval time (seconds) = '+FormatMetric(metrics['document_retrieval_seconds'],3)
+    if metrics.get('document_error'):
+        metrics_string+='\nDocuments not used: '+metrics['document_error']
     metrics_string+='\nMax context tokens = '+str(metrics['context_length'])
     metrics_string+='\nResponse tokens = '+str(metrics['eval_count'])
     metrics_string+='\nMax response tokens = '+str(metrics['embedding_length'])
@@ -50,6 +353,29 @@ def DisplayMetrics(metrics):
     milliseconds=metrics['total_duration']/1000000
     seconds=round(milliseconds/1000,2)
     metrics_string+='\nDuration (seconds) = '+str(seconds)
+    if metrics.get('cache_hit'):
+        metrics_string+='\nReplayed from the response cache (durations and rates are from the original response)'
+    if metrics.get('hedged'):
+        winner='the second host' if metrics['hedge_won'] else 'the first host'
+        metrics_string+='\nHedged: no token after '+str(HEDGE_DELAY_SECONDS)+' seconds, so a second host was asked too. The response is from '+winner
+    if metrics.get('cancelled'):
+        metrics_string+='\nStopped by the user after '+str(metrics['eval_count'])+' response tokens'
+    if metrics.get('done_reason')=='incomplete':
+        metrics_string+='\nThe response ended without its final chunk after '+str(metrics['eval_count'])+' response tokens'
+    # Older logs do not have the latency metrics or the streaming CPU time
+    if metrics.get('queue_wait') is not None:
+        metrics_string+='\nQueue wait (seconds) = '+FormatMetric(metrics['queue_wait'],2)
+    if 'ttft' in metrics:
+        metrics_string+='\nModel load time (seconds) = '+FormatMetric(metrics['load_seconds'],2)
+        metrics_string+='\nTime to first token (seconds) = '+FormatMetric(metrics['ttft'],2)
+        metrics_string+='\nInter-token latency p50/p99 (milliseconds) = '+FormatMetric(metrics['itl_p50'],1,1000)+' / '+FormatMetric(metrics['itl_p99'],1,1000)
+        metrics_string+='\nPrompt eval time (seconds) = '+FormatMetric(metrics.get('prompt_eval_duration'),3,1e-9)
+        metrics_string+='\nPrompt eval rate (tokens/second) = '+FormatMetric(metrics['prompt_eval_rate'],1)
+        metrics_string+='\nGeneration rate (tokens/second) = '+FormatMetric(metrics['eval_rate'],1)
+    if 'stream_cpu_seconds' in metrics and metrics['eval_count']:
+        cpu_per_token=round(metrics['stream_cpu_seconds']*1000/metrics['eval_count'],3)
+        batching='batched' if metrics['batch_mode'] else 'not batched'
+        metrics_string+=f'\nStreaming CPU per token (milliseconds) = {cpu_per_token} ({batching})'
     metrics_string+='\nSystem prompt = '+metrics['system_prompt']
     with st.expander(
                 label='Response Metrics',
@@ -109,10 +435,41 @@ def CheckSystemMessage(messages_key,system_key):
             # if there are no message then append the system message
             st.session_state[messages_key].append(message)
 
+# Only the last HISTORY_WINDOW turns (a question and its response) are fully rendered.
+# Earlier turns are collapsed into a stub, and each press of Show Earlier loads another window.
+# This keeps the render time and websocket payload of a rerun flat as a conversation grows.
+HISTORY_WINDOW=10
+
+def DisplayMessage(msg,stopped=False):
+    """ Display one message in a box with an icon and role name.
+    A response stopped by the user is labeled as stopped."""
+    match msg['role']:
+        case 'user':
+            label='Question'
+            icon=':material/person:'
+        case 'assistant':
+            label='Response (stopped)' if stopped else 'Response'
+            icon=':material/smart_toy:'
+        case 'system':
+            label='System'
+            icon=':material/psychology:'
+        case _:
+            label=msg['role']
+            icon=':material/stylus:'
+    with st.expander(
+                label=label,
+                expanded=True,
+                icon=icon):
+        if st.session_state['clipboard_mode']:
+            st.code(msg['content'], language='markdown', wrap_lines=True)
+        else:
+            st.markdown(msg['content'])
+
 def DisplayChatHistory(messages_key,system_key,metrics_key):
     """ Display the chat history if there is one. Each message is placed in a
     box with an icon and role name. Every response message is followed by the
     metrics from that query and response.
+    The system message and the last turns are shown; older turns are hidden behind a stub.
     If this module has just launched then create empty lists to fill in later.
     Assume there is one metrics entry for each response message. No checks are made to ensure this.
     Since the user can restore a session from files they can edit, this may not be true.
@@ -121,82 +478,141 @@ def DisplayChatHistory(messages_key,system_key,metrics_key):
         st.session_state[messages_key]=list()
         st.session_state[metrics_key]=list()
     CheckSystemMessage(messages_key,system_key)
-    if len(st.session_state[messages_key]):
-        metricsIndex=0
-        for msg in st.session_state[messages_key]:
-            match msg['role']:
-                case 'user':
-                    label='Question'
-                    icon=':material/person:'
-                case 'assistant':
-                    label='Response'
-                    icon=':material/smart_toy:'
-                case 'system':
-                    label='System'
-                    icon=':material/psychology:'
-                case _:
-                    label=msg['role']
-                    icon=':material/stylus:'
-            with st.expander(
-                        label=label,
-                        expanded=True,
-                        icon=icon):
-                if st.session_state['clipboard_mode']:
-                    st.code(msg['content'], language='markdown', wrap_lines=True)
-                else:
-                    st.markdown(msg['content'])
+    messages=st.session_state[messages_key]
+    if len(messages):
+        window_key=messages_key+'_window'
+        if window_key not in st.session_state:
+            st.session_state[window_key]=HISTORY_WINDOW
+        # Each turn starts with a question. Find the first message of the first turn to show.
+        turn_starts=[i for i,msg in enumerate(messages) if msg['role']=='user']
+        hidden_turns=max(len(turn_starts)-st.session_state[window_key],0)
+        first_shown=turn_starts[hidden_turns] if hidden_turns else 0
+        if messages[0]['role']=='system':
+            DisplayMessage(messages[0])
+        if hidden_turns:
+            stub_cols=st.columns((2,1,1),vertical_alignment='center')
+            stub_cols[0].caption(f'{hidden_turns} earlier questions and responses are hidden.')
+            if stub_cols[1].button(
+                    'Show Earlier',
+                    help=f'Show up to {HISTORY_WINDOW} more earlier questions and responses',
+                    key=window_key+'_more',
+                    use_container_width=True):
+                st.session_state[window_key]+=HISTORY_WINDOW
+                st.rerun()
+        if st.session_state[window_key]>HISTORY_WINDOW:
+            if st.button(
+                    'Hide Earlier',
+                    help=f'Show only the last {HISTORY_WINDOW} questions and responses',
+                    key=window_key+'_less'):
+                st.session_state[window_key]=HISTORY_WINDOW
+                st.rerun()
+        # The metrics entry for a response is found by counting the responses before it
+        metricsIndex=sum(1 for msg in messages[:first_shown] if msg['role']=='assistant')
+        for msg in messages[first_shown:]:
+            if msg['role']=='system':
+                continue
             if msg['role']=='assistant':
-                DisplayMetrics(st.session_state[metrics_key][metricsIndex])
+                metrics=st.session_state[metrics_key][metricsIndex]
+                DisplayMessage(msg,metrics.get('cancelled',False))
+                DisplayMetrics(metrics)
                 metricsIndex+=1
+            else:
+                DisplayMessage(msg)
     st.divider()
 
+# Session messages and metrics are saved in the conversation store (ChatbotStore.db), see ChatbotStore.py.
+# session_log_key holds the id of the session in the store and metrics_log_key holds its name.
+
 def UpdateSessionLogs(session_log_key,metrics_log_key,messages_key,metrics_key):
-    """ Create or update logs of the prompts, responses, and metrics in the session."""
-    if session_log_key not in st.session_state:
-        # Create filenames for this session log and the metrics log.
-        # Create new log files if they do not exist.
+    """ Save the prompts, responses, and metrics in the session to the conversation store.
+    Only records added since the last update are inserted. The system message is saved
+    when the session is created; later edits are saved in the system_prompt of each metrics entry."""
+    store=ConversationStore()
+    new_log=session_log_key not in st.session_state
+    if new_log:
         now=time.strftime('%Y-%m-%d-%H%M%S')
-        cb_session_log_file=f'ChatbotSession_{now}.log'
-        st.session_state[session_log_key] = cb_session_log_file
-        cb_metrics_log_file=f'ChatbotSession_{now}_metrics.log'
-        st.session_state[metrics_log_key] = cb_metrics_log_file
-        with open(cb_session_log_file, 'w') as f:
-            f.write('Chatbot Session Log\n')
-        with open(cb_metrics_log_file, 'w') as f:
-            f.write('Chatbot Metrics Log\n')
-    # Write the current prompt and response to the session log file
-    with open(st.session_state[session_log_key], 'w') as f:
-        json.dump(st.session_state[messages_key], f, indent=4)
-    # Write the current metrics to the metrics log file
-    with open(st.session_state[metrics_log_key], 'w') as f:
-        json.dump(st.session_state[metrics_key], f, indent=4)
-
-@st.dialog('Restore a preior session')
-def RestoreSessionLogs(messages_key,metrics_key):
-    """ Restore the session and metrics lists from user provided log files.
-    There is no check to see if the files are valid. """
-    st.write('## Restore Session Logs')
+        st.session_state[metrics_log_key]=f'ChatbotSession_{now}_{SessionId()}'
+        st.session_state[session_log_key]=CreateSession(store,st.session_state[metrics_log_key])
+        st.session_state[session_log_key+'_count']=0
+        st.session_state[metrics_log_key+'_count']=0
+    # Count only user and assistant messages - the system message may be inserted or removed at any time
+    written=st.session_state[session_log_key+'_count']
+    conversation=[msg for msg in st.session_state[messages_key] if msg['role']!='system']
+    records=conversation[written:]
+    if new_log:
+        records=[msg for msg in st.session_state[messages_key] if msg['role']=='system']+records
+    written_metrics=st.session_state[metrics_log_key+'_count']
+    AppendSessionRecords(store,st.session_state[session_log_key],records,st.session_state[metrics_key][written_metrics:])
+    st.session_state[session_log_key+'_count']=len(conversation)
+    st.session_state[metrics_log_key+'_count']=len(st.session_state[metrics_key])
+
+def ContinueSession(messages_key,metrics_key,session_log_key,metrics_log_key,summary_key,context_key,session):
+    """ Load a stored session into the conversation and keep saving to it.
+    The summary and automatic context size of the replaced conversation are dropped, as in RestoreHit."""
+    messages,metrics=LoadSession(ConversationStore(),session['id'])
+    # The summary job is cancelled like CancelSummary in ChatbotContext.py, which imports this module
+    CancelResponse(summary_key+'_job')
+    for k in (summary_key,context_key+'_auto'):
+        if k in st.session_state:
+            del st.session_state[k]
+    st.session_state[messages_key]=messages
+    st.session_state[metrics_key]=metrics
+    st.session_state[session_log_key]=session['id']
+    st.session_state[metrics_log_key]=session['name']
+    st.session_state[session_log_key+'_count']=sum(1 for msg in messages if msg['role']!='system')
+    st.session_state[metrics_log_key+'_count']=len(metrics)
+
+@st.dialog('Restore a preior session',width='large')
+def RestoreSessionLogs(messages_key,metrics_key,session_log_key,metrics_log_key,job_key,summary_key,context_key):
+    """ Restore the session and metrics lists from the conversation store.
+    The restored session continues to be saved with the next response.
+    Old session and metrics log files can be uploaded one pair at a time, or imported in bulk.
+    Nothing can be restored while a response is generating, or it would be added to the restored session. """
+    st.write('## Restore Session')
     st.divider()
-    st.markdown('Upload the session log file (ChatbotSession_*.log) and the metrics log file (ChatbotSession_*_metrics.log)')
-    st.markdown('The session log file contains the chat history and the metrics log file contains the metrics for each response.')
-    # Upload the session log file
-    st.markdown('\n\nSession log file:')
-    session_log_file=st.file_uploader(
-            label='Upload a session log file',
-            type='log',
-            label_visibility='collapsed')
-    # Upload the metrics log file
-    st.markdown('Metrics log file:')
-    metrics_log_file=st.file_uploader(
-            label='Upload a metrics log file',
-            type='log',
-            label_visibility='collapsed')
-    if session_log_file and metrics_log_file:
-        # Read the session log file and restore the messages list
-        st.session_state[messages_key]=json.load(session_log_file)
-        # Read the metrics log file and restore the metrics list
-        st.session_state[metrics_key]=json.load(metrics_log_file)
-        st.write('Session restored.')
+    busy=job_key in st.session_state
+    if busy:
+        st.caption(':orange[Wait for the response in the chat to finish before restoring a session.]')
+    store=ConversationStore()
+    sessions=ListSessions(store)
+    if sessions:
+        labels={s['id']:f'{s["updated"]} - {s["title"] or "(no question)"} ({s["message_count"]} messages, {s["model"] or "no model"})'
+                for s in sessions}
+        selected=st.selectbox(
+                'Select a session',
+                list(labels.keys()),
+                format_func=lambda session_id: labels[session_id],
+                help=f'The {STORE_LIST_LIMIT} most recently updated sessions')
+        if st.button('Restore',disabled=busy):
+            ContinueSession(messages_key,metrics_key,session_log_key,metrics_log_key,summary_key,context_key,
+                            next(s for s in sessions if s['id']==selected))
+            st.write('Session restored.')
+    else:
+        st.write('There are no saved sessions yet.')
+    with st.expander('Import session log files'):
+        st.markdown('Upload a session log file (ChatbotSession_*.log) and its metrics log file (ChatbotSession_*_metrics.log)')
+        # Upload the session log file
+        session_log_file=st.file_uploader(
+                label='Session log file',
+                type='log',
+                disabled=busy)
+        # Upload the metrics log file
+        metrics_log_file=st.file_uploader(
+                label='Metrics log file',
+                type='log',
+                disabled=busy)
+        if session_log_file and metrics_log_file:
+            name=session_log_file.name[:-4]
+            session_id=ImportLogPair(store,name,session_log_file,metrics_log_file)
+            if session_id is None:
+                session_id=next(s['id'] for s in ListSessions(store,limit=-1) if s['name']==name)
+            ContinueSession(messages_key,metrics_key,session_log_key,metrics_log_key,summary_key,context_key,
+                            {'id':session_id,'name':name})
+            st.write('Session restored.')
+        st.markdown('Or import every log file pair in the working directory. Pairs imported before are skipped.')
+        if st.button('Import All Log Files'):
+            imported,skipped=ImportLogFiles(store)
+            st.write(f'Imported {imported} sessions, skipped {skipped}.')
     st.write('Press :red[Close] to close this dialog.')
     if st.button('Close'):
         st.rerun()
@@ -256,7 +672,7 @@ def ShowModel():
                     expanded=False,
                     icon=':material/stylus:'):
             if model in st.session_state:
-                model_info=ollama.show(st.session_state[model])
+                model_info=OllamaClient().show(st.session_state[model])
             else:
                 model_info=f'{model} has not been selected yet.'
             st.write(model_info)
@@ -264,21 +680,34 @@ def ShowModel():
 def ListModels():
     """ Show all available models """
     st.write('### List Available Models')
-    model_list=ollama.list()
+    model_list=OllamaClient().list()
     st.write(model_list)
     return
 
 def ShowRunningModels():
-    """ Display models currently active in ollama """
+    """ Display models currently active in ollama, with their memory use and when they will be unloaded """
     st.write('### Show Running Models')
-    running_list=ollama.ps()
-    st.write(running_list)
+    running_list=OllamaClient().ps()
+    rows=list()
+    for m in running_list['models']:
+        rows.append({
+                'Model':m['model'],
+                'Size (GB)':round(m['size']/1000000000,2),
+                'In VRAM (GB)':round(m['size_vram']/1000000000,2),
+                'Unloads at':m['expires_at'][:19].replace('T',' ')})
+    st.dataframe(rows,hide_index=True,use_container_width=True)
+    with st.expander('Ollama ps output'):
+        st.write(running_list)
 
 def ResetModule():
     """ This does the same as a browser refresh but preserves the log and sys_models. """
     st.divider()
     st.write('## Reset Module')
     for k in st.session_state.keys():
+        # Stop the responses and summaries still being generated before their jobs are dropped
+        job=st.session_state[k]
+        if isinstance(job,dict) and isinstance(job.get('cancel'),threading.Event):
+            job['cancel'].set()
         if k == 'log':
             st.session_state['log'].info('Application reset - session_state cleared')
         elif k[:4] == 'sys_':
@@ -287,12 +716,15 @@ def ResetModule():
             del st.session_state[k]
     st.write('Application State Was Reset :material/reset_settings:')
 
-def ResetModel(model_key,old_model_key,system_key):
+def ResetModel(model_key,old_model_key,system_key,context_key=None,keep_alive_key=None,job_key=None):
     """ Reset the model to the default model. This is called when the user
     selects a different model from the sidebar.
     Deleting cb_system causes SetSystemMessage() to check if there is a model default system prompt.
     A simple delete of the system_key results in issues - can't edit/update system prompt.
     Instead need to check if the new model is different from the old model.
+    With a context_key, the new model is loaded in the background while the user types the next prompt,
+    unless the session unloads its model after each response. It is loaded on the host that the
+    conversation of job_key is routed to, so the next response finds it loaded.
     """
     if "_"+model_key not in st.session_state.keys():
         return
@@ -301,64 +733,215 @@ def ResetModel(model_key,old_model_key,system_key):
         old_model_key=model_key
         if system_key in st.session_state:
             del st.session_state[system_key]
+    if context_key:
+        model=st.session_state[model_key]
+        # Load with the num_ctx the next request will use, or Ollama loads the model again
+        num_ctx=st.session_state.get(context_key,2048)
+        if st.session_state.get('auto_context_mode'):
+            num_ctx=st.session_state.get(context_key+'_auto',2048)
+        num_ctx=min(num_ctx,st.session_state['sys_models'][model]['context_length'])
+        keep_alive=KeepAlive(keep_alive_key)
+        # A model that is unloaded after each response would be unloaded again as soon as it was prewarmed
+        if keep_alive!=0:
+            pool=BackendPool()
+            PrewarmModel(pool,BackendClients(pool),ConversationId(SessionId(),job_key),model,num_ctx,keep_alive)
+
+# Ollama unloads a model KEEP_ALIVE_DEFAULT after its last request. Each session can choose to
+# keep its model loaded longer, or to unload it as soon as each response is complete.
+KEEP_ALIVE_CHOICES={'5 minutes':'5m',
+                    '30 minutes':'30m',
+                    '2 hours':'2h',
+                    'Until Ollama stops':-1,
+                    'Unload after each response':0}
+KEEP_ALIVE_DEFAULT='5 minutes'
+
+def KeepAlive(keep_alive_key):
+    """ The keep_alive value for Ollama requests from the session choice in keep_alive_key."""
+    if keep_alive_key not in st.session_state:
+        return KEEP_ALIVE_CHOICES[KEEP_ALIVE_DEFAULT]
+    return KEEP_ALIVE_CHOICES[st.session_state[keep_alive_key]]
+
+def PrewarmModel(pool,clients,conversation,model,num_ctx,keep_alive):
+    """ Load a model in a background thread so the first response doesn't wait for it.
+    A generate request without a prompt loads the model and returns."""
+    threading.Thread(target=PrewarmWorker,args=[pool,clients,conversation,model,num_ctx,keep_alive],daemon=True).start()
+
+def PrewarmWorker(pool,clients,conversation,model,num_ctx,keep_alive):
+    """ Load the model on the conversation's host. This runs in a background thread, so it must not call Streamlit."""
+    host=SelectBackend(pool,clients,conversation,model)
+    error=None
+    try:
+        response=clients[host].generate(model=model,options={'num_ctx':num_ctx},keep_alive=keep_alive)
+        load_seconds=response.get('load_duration',0)/1000000000
+        logging.getLogger().info(f'Prewarmed {model} on {host} with num_ctx {num_ctx} - load time = {load_seconds:.2f} seconds')
+    except Exception as e:
+        error=e
+        logging.getLogger().warning(f'Prewarm of {model} on {host} failed: {e}')
+    EndRequest(pool,host,model,error)
+
+# Parsed model details are cached on disk, keyed by the digest and modified_at reported by ollama.list().
+# On startup only new or changed models are queried with ollama.show(), using up to INVENTORY_WORKERS threads.
+MODEL_CACHE_FILE='ChatbotModels.cache'
+INVENTORY_WORKERS=8
+
+def ParseModelInfo(model,model_info):
+    """ Build the sys_models entry for one model from its ollama.list() entry and ollama.show() output."""
+    model_name=model['model']
+    model_parameter_size=model['details']['parameter_size']
+    try:
+        # Note: ollama package version 0.4.8 does not include this data
+        model_system_prompt=model_info['system']
+    except KeyError:
+        pass
+    # Note: for ollama package version > 0.3.3
+    # - change model_info.keys() to model_info.model_dump().keys()
+    # - change k == 'model_info' to k == 'modelinfo'
+    for k in model_info.keys():
+        if k == 'details':
+            model_quantization_level=model_info[k]['quantization_level']
+        if k == 'model_info':
+            for p in model_info[k].keys():
+                # Context length is capped at 100k (102400) even though some models have larger context lengths.
+                # Vision embedding length is not currently used in the chatbot module.
+                if ".context_length" == p[-15:]:
+                    model_context_length=model_info[k][p]
+                    if model_context_length > 102400:
+                        model_context_length=102400
+                elif "vision.embedding_length" == p[-23:]:
+                    model_vision_embedding_length=model_info[k][p]
+                elif ".embedding_length" == p[-17:]:
+                    model_embedding_length=model_info[k][p]
+    model_dictionary={
+            'name':model_name,
+            'digest':model['digest'],
+            'size':model['size'],
+            'parameter_size':model_parameter_size,
+            'quantization_level':model_quantization_level,
+            'context_length':model_context_length,
+            'embedding_length':model_embedding_length
+            }
+    try:
+        model_dictionary['vision_embedding_length']=model_vision_embedding_length
+    except NameError:
+        pass
+    try:
+        model_dictionary['system_prompt']=model_system_prompt
+    except NameError:
+        pass
+    return model_dictionary
+
+def LoadModelCache():
+    """ Load the cached sys_models entries. A missing or damaged cache file is treated as empty."""
+    try:
+        with open(MODEL_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return dict()
+
+def SaveModelCache(model_cache):
+    """ Save the cached sys_models entries. Write a temporary file first so a crash can't leave a partial cache."""
+    temp_file=MODEL_CACHE_FILE+'.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(model_cache, f, indent=4)
+    os.replace(temp_file, MODEL_CACHE_FILE)
+
+def BuildModelInventory(clients,model_list):
+    """ Build the sys_models dictionary for the models in an ollama.list() result.
+    Models whose digest and modified_at match the disk cache are not queried again.
+    The rest are queried concurrently with ollama.show(), using the client in clients for each model name."""
+    model_cache=LoadModelCache()
+    sys_models=dict()
+    changed_models=list()
+    for model in model_list:
+        cache_key=[model['digest'],str(model['modified_at'])]
+        cached=model_cache.get(model['model'])
+        if cached and cached['key']==cache_key:
+            sys_models[model['model']]=cached['model']
+        else:
+            changed_models.append(model)
+    if changed_models:
+        with ThreadPoolExecutor(max_workers=INVENTORY_WORKERS) as pool:
+            model_infos=pool.map(lambda m: clients[m['model']].show(m['model']), changed_models)
+            for model,model_info in zip(changed_models,model_infos):
+                sys_models[model['model']]=ParseModelInfo(model,model_info)
+    # Rewrite the cache if anything changed, dropping models that were removed
+    if changed_models or len(model_cache)!=len(model_list):
+        model_cache={m['model']:{'key':[m['digest'],str(m['modified_at'])],
+                                 'model':sys_models[m['model']]} for m in model_list}
+        SaveModelCache(model_cache)
+    # Keep the ollama.list() order - the selectbox defaults to the first (most recent) model
+    return {m['model']:sys_models[m['model']] for m in model_list}
+
+# Every browser session shares one read-only model registry, created once per process.
+# At most every REGISTRY_CHECK_SECONDS a background thread compares ollama.list() with the
+# registry and rebuilds it if a model was added, removed, or changed.
+REGISTRY_CHECK_SECONDS=60
+
+@st.cache_resource
+def ModelRegistry():
+    """ The process-wide model registry. The models mapping is replaced, never edited,
+    so sessions holding a reference to the old mapping are unaffected by a refresh."""
+    return {'models':MappingProxyType(dict()),
+            'signature':None,
+            'checked':0.0,
+            'lock':threading.Lock()}
+
+def ListHostModels(clients):
+    """ The ollama.list() models of each host that responds, with all the hosts asked at once."""
+    def ListModels(host):
+        try:
+            return host,clients[host].list()['models']
+        except Exception as e:
+            logging.getLogger().warning(f'Ollama host {host} did not list its models: {e}')
+            return host,None
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        return {host:models for host,models in executor.map(ListModels,clients) if models is not None}
+
+def RefreshModelRegistry(registry,clients):
+    """ Rebuild the registry if ollama.list() on any host has changed since the last check.
+    The registry has every model on any host, each described by the first host that has it,
+    so a model only on a later host can still be selected. clients is from BackendClients.
+    This runs in a background thread after the first build, so it must not call Streamlit."""
+    with registry['lock']:
+        try:
+            host_models=ListHostModels(clients)
+            if not host_models:
+                raise ConnectionError('No Ollama host responded')
+            signature=[[host,m['model'],m['digest'],str(m['modified_at'])] for host,models in host_models.items() for m in models]
+            if signature!=registry['signature']:
+                model_list=list()
+                model_clients=dict()
+                for host,models in host_models.items():
+                    for model in models:
+                        if model['model'] not in model_clients:
+                            model_clients[model['model']]=clients[host]
+                            model_list.append(model)
+                registry['models']=MappingProxyType(BuildModelInventory(model_clients,model_list))
+                registry['signature']=signature
+                logging.getLogger().info(f'Model registry refreshed: {len(model_list)} models on {len(host_models)} hosts')
+        except Exception as e:
+            # Keep serving the old registry if Ollama can't be reached
+            if registry['signature'] is None:
+                raise
+            logging.getLogger().warning(f'Model registry refresh failed: {e}')
+        registry['checked']=time.monotonic()
 
-@st.cache_data
 def InventoryModels():
     """ Inventory available models. Add features/parameters to st.session_state.
     Selected details are included in every metrics summary displayed to the user.
-    The max context length is used to set the slider max_value."""
-    st.session_state['sys_models']=dict()
-    for model in ollama.list()['models']:
-        try:
-            del model_vision_embedding_length
-        except NameError:
-            pass
-        try:
-            del model_system_prompt
-        except NameError:
-            pass
-        model_name=model['model']
-        model_parameter_size=model['details']['parameter_size']
-        model_info=ollama.show(model['model'])
-        try:
-            # Note: ollama package version 0.4.8 does not include this data
-            model_system_prompt=model_info['system']
-        except KeyError:
-            pass
-        # Note: for ollama package version > 0.3.3
-        # - change model_info.keys() to model_info.model_dump().keys()
-        # - change k == 'model_info' to k == 'modelinfo'
-        for k in model_info.keys():
-            if k == 'details':
-                model_quantization_level=model_info[k]['quantization_level']
-            if k == 'model_info':
-                for p in model_info[k].keys():
-                    # Context length is capped at 100k (102400) even though some models have larger context lengths.
-                    # Vision embedding length is not currently used in the chatbot module.
-                    if ".context_length" == p[-15:]:
-                        model_context_length=model_info[k][p]
-                        if model_context_length > 102400:
-                            model_context_length=102400
-                    elif "vision.embedding_length" == p[-23:]:
-                        model_vision_embedding_length=model_info[k][p]
-                    elif ".embedding_length" == p[-17:]:
-                        model_embedding_length=model_info[k][p]
-        model_dictionary={
-                'name':model_name,
-                'parameter_size':model_parameter_size,
-                'quantization_level':model_quantization_level,
-                'context_length':model_context_length,
-                'embedding_length':model_embedding_length
-                }
-        try:
-            model_dictionary['vision_embedding_length']=model_vision_embedding_length
-        except NameError:
-            pass
-        try:
-            model_dictionary['system_prompt']=model_system_prompt
-        except NameError:
-            pass
-        st.session_state['sys_models'][model_name] = model_dictionary
+    The max context length is used to set the slider max_value.
+    st.session_state['sys_models'] is a reference to the shared registry, not a copy,
+    and has the models of every Ollama host.
+    The first call builds the registry; later calls start a background refresh when it is due."""
+    registry=ModelRegistry()
+    clients=BackendClients(BackendPool())
+    if registry['signature'] is None:
+        RefreshModelRegistry(registry,clients)
+    elif time.monotonic()-registry['checked']>REGISTRY_CHECK_SECONDS:
+        # Claim this check so other sessions don't start a refresh too
+        registry['checked']=time.monotonic()
+        threading.Thread(target=RefreshModelRegistry,args=[registry,clients],daemon=True).start()
+    st.session_state['sys_models']=registry['models']
 
 def InitializeLogging():
     """ My typical Python logging utility adapted for Streamlit
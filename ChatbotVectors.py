@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+""" Embedding vectors for text, from a local Ollama embedding model, cached on disk.
+Each embedding model has its own index in VECTOR_DIRECTORY:
+- <model>.f32 holds the vectors, one float32 row each, scaled to length 1 so a dot product is the cosine similarity
+- <model>.keys holds the dimension, then the content hash of each row in the same order
+The same text is only embedded once per model, however many times it appears.
+The vector file is memory-mapped, so a search reads the whole matrix in one NumPy product
+without loading a copy of it.
+"""
+import os
+import re
+import hashlib
+import threading
+import numpy as np
+import streamlit as st
+from ChatbotUtilities import (load_key,update_key)
+
+VECTOR_DIRECTORY='ChatbotVectors'
+# Texts sent to the embedding model in one request
+VECTOR_BATCH=32
+
+@st.cache_resource
+def VectorIndex(model):
+    """ The process-wide index for an embedding model, shared by every browser session.
+    - rows: the row of each content hash
+    - hashes: the content hash of each row
+    - matrix: the memory-mapped vectors, or None before the first is added
+    - messages, scanned, backfill: the stored messages indexed so far, see ChatbotSearch.py
+    """
+    os.makedirs(VECTOR_DIRECTORY,exist_ok=True)
+    name=os.path.join(VECTOR_DIRECTORY,re.sub(r'[^A-Za-z0-9_.-]','_',model))
+    index={'model':model,
+           'vector_file':name+'.f32',
+           'keys_file':name+'.keys',
+           'dimension':None,
+           'rows':dict(),
+           'hashes':list(),
+           'matrix':None,
+           'messages':dict(),
+           'scanned':0,
+           'backfill':None,
+           'lock':threading.Lock()}
+    if os.path.exists(index['keys_file']):
+        with open(index['keys_file'],'r',encoding='utf-8') as f:
+            lines=f.read().split()
+        if lines:
+            index['dimension']=int(lines[0])
+            hashes=lines[1:]
+            # The vectors are written before their keys, so a crash can only leave extra vectors.
+            # Cut them off so the next vectors line up with their keys again.
+            size=os.path.getsize(index['vector_file']) if os.path.exists(index['vector_file']) else 0
+            hashes=hashes[:size//(4*index['dimension'])]
+            if size>len(hashes)*4*index['dimension']:
+                with open(index['vector_file'],'r+b') as f:
+                    f.truncate(len(hashes)*4*index['dimension'])
+            index['rows']={h:row for row,h in enumerate(hashes)}
+            index['hashes']=hashes
+            MapVectors(index,len(hashes))
+    return index
+
+def EmbeddingModelSelect(key,help,container=st):
+    """ Select the embedding model kept in key. It defaults to the first model that looks like an embedding model."""
+    models=st.session_state['sys_models']
+    model_list=list(models.keys())
+    if st.session_state.get(key) not in model_list:
+        st.session_state[key]=next((m for m in model_list if 'embed' in m),model_list[0])
+    load_key(key)
+    return container.selectbox(
+            'Embedding model',
+            model_list,
+            format_func=lambda m: f'{m} ({models[m]["embedding_length"]} dimensions)',
+            help=help+' Use an embedding model, such as nomic-embed-text.',
+            key='_'+key,
+            on_change=update_key,
+            args=[key])
+
+def MapVectors(index,count):
+    """ Memory-map the first count rows of the vector file. The caller holds the lock or owns the index."""
+    if count:
+        index['matrix']=np.memmap(index['vector_file'],dtype=np.float32,mode='r',shape=(count,index['dimension']))
+
+def ContentHash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def EmbedTexts(client,model,texts,keep_alive=None):
+    """ Embed texts in one request and return the vectors as rows scaled to length 1."""
+    response=client.embed(model=model,input=texts,keep_alive=keep_alive)
+    vectors=np.asarray(response['embeddings'],dtype=np.float32)
+    norms=np.linalg.norm(vectors,axis=1,keepdims=True)
+    return vectors/np.maximum(norms,1e-12)
+
+def AddVectors(index,hashes,vectors):
+    """ Append vectors to the index. Hashes already in the index, added by another thread, are skipped."""
+    with index['lock']:
+        if index['dimension'] is None:
+            index['dimension']=vectors.shape[1]
+            with open(index['keys_file'],'w',encoding='utf-8') as f:
+                f.write(f'{index["dimension"]}\n')
+        new=[i for i,h in enumerate(hashes) if h not in index['rows']]
+        if not new:
+            return
+        with open(index['vector_file'],'ab') as f:
+            f.write(np.ascontiguousarray(vectors[new],dtype=np.float32).tobytes())
+        with open(index['keys_file'],'a',encoding='utf-8') as f:
+            f.write(''.join(hashes[i]+'\n' for i in new))
+        for i in new:
+            index['rows'][hashes[i]]=len(index['hashes'])
+            index['hashes'].append(hashes[i])
+        MapVectors(index,len(index['rows']))
+
+def EmbedMissing(client,index,texts,keep_alive=None):
+    """ Embed the texts that are not in the index yet, VECTOR_BATCH at a time, and return the row of each text.
+    This is called from background threads."""
+    hashes=[ContentHash(text) for text in texts]
+    missing=dict()
+    for h,text in zip(hashes,texts):
+        if h not in index['rows']:
+            missing[h]=text
+    missing_hashes=list(missing.keys())
+    for start in range(0,len(missing_hashes),VECTOR_BATCH):
+        batch=missing_hashes[start:start+VECTOR_BATCH]
+        AddVectors(index,batch,EmbedTexts(client,index['model'],[missing[h] for h in batch],keep_alive))
+    return [index['rows'][h] for h in hashes]
+
+def NearestRows(index,queries,k,rows=None):
+    """ For each query vector, the k most similar rows and their cosine similarity, best first.
+    All the queries are scored in one matrix product. rows limits the search to those rows."""
+    matrix=index['matrix']
+    if matrix is None or k<=0:
+        return [list() for _ in queries]
+    candidates=np.arange(matrix.shape[0]) if rows is None else np.unique(np.asarray(rows,dtype=np.int64))
+    if not len(candidates):
+        return [list() for _ in queries]
+    queries=np.atleast_2d(np.asarray(queries,dtype=np.float32))
+    if len(candidates)*4<matrix.shape[0]:
+        # A few rows - copy them out rather than score the whole matrix
+        scores=queries@matrix[candidates].T
+    else:
+        scores=(queries@matrix.T)[:,candidates]
+    k=min(k,len(candidates))
+    results=list()
+    for row_scores in scores:
+        top=np.argpartition(-row_scores,k-1)[:k]
+        top=top[np.argsort(-row_scores[top])]
+        results.append([(int(candidates[i]),float(row_scores[i])) for i in top])
+    return results
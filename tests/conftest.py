@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+""" The chatbot modules are scripts in the repository root rather than a package."""
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
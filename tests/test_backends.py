@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+""" Backend selection against stand-in Ollama hosts.
+Each stand-in host answers list() and ps() like Ollama: one has the model, one is running but
+doesn't have the model, and one port has nothing listening.
+"""
+import json
+import socket
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import httpx
+import pytest
+
+import ChatbotBackends
+from ChatbotBackends import (
+        BackendPool,
+        BackendClients,
+        RefreshBackends,
+        SelectBackend,
+        EndRequest,
+        BACKEND_STICKY_SLACK)
+
+MODEL='tiny:1b'
+
+def StandInHost(models,resident):
+    """ Start an HTTP server that answers the Ollama list and ps requests. Return the server and its URL."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self,*args):
+            pass
+        def do_GET(self):
+            if self.path=='/api/tags':
+                names=models
+            elif self.path=='/api/ps':
+                names=resident
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body=json.dumps({'models':[{'name':m,'model':m} for m in names]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    server=ThreadingHTTPServer(('127.0.0.1',0),Handler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server,f'http://127.0.0.1:{server.server_address[1]}'
+
+def UnusedPort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1',0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope='module')
+def hosts():
+    """ The URLs of the stand-in hosts, by role."""
+    servers=dict()
+    urls=dict()
+    for role,models,resident in (('healthy',[MODEL],[]),
+                                 ('second',[MODEL],[MODEL]),
+                                 ('missing',['other:7b'],[])):
+        servers[role],urls[role]=StandInHost(models,resident)
+    urls['unreachable']=f'http://127.0.0.1:{UnusedPort()}'
+    yield urls
+    for server in servers.values():
+        server.shutdown()
+
+def NewPool(monkeypatch,host_list):
+    """ A fresh backend pool and its clients for the hosts."""
+    monkeypatch.setattr(ChatbotBackends,'BACKEND_HOSTS',host_list)
+    BackendPool.clear()
+    pool=BackendPool()
+    return pool,BackendClients(pool)
+
+def test_refresh_checks_every_host(monkeypatch,hosts):
+    pool,clients=NewPool(monkeypatch,[hosts['healthy'],hosts['missing'],hosts['unreachable']])
+    RefreshBackends(pool,clients)
+    state=pool['hosts']
+    assert pool['checked'] is not None
+    assert state[hosts['healthy']]['healthy'] and state[hosts['healthy']]['models']=={MODEL}
+    assert state[hosts['missing']]['healthy'] and MODEL not in state[hosts['missing']]['models']
+    assert not state[hosts['unreachable']]['healthy']
+
+def test_select_skips_unhealthy_hosts_and_hosts_without_the_model(monkeypatch,hosts):
+    # The unreachable host is first, so the selection can't be the fallback to the first host
+    pool,clients=NewPool(monkeypatch,[hosts['unreachable'],hosts['missing'],hosts['healthy']])
+    for i in range(3):
+        assert SelectBackend(pool,clients,f'conversation {i}',MODEL)==hosts['healthy']
+    assert pool['hosts'][hosts['healthy']]['inflight']==3
+    assert pool['hosts'][hosts['unreachable']]['inflight']==0
+    assert pool['hosts'][hosts['missing']]['inflight']==0
+
+def test_select_least_inflight(monkeypatch,hosts):
+    pool,clients=NewPool(monkeypatch,[hosts['healthy'],hosts['second']])
+    RefreshBackends(pool,clients)
+    pool['hosts'][hosts['healthy']]['inflight']=2
+    assert SelectBackend(pool,clients,'a',MODEL)==hosts['second']
+    assert SelectBackend(pool,clients,'b',MODEL)==hosts['second']
+    # Both hosts have 2 in flight - the one that has the model loaded wins the tie
+    assert SelectBackend(pool,clients,'c',MODEL)==hosts['second']
+    EndRequest(pool,hosts['second'],MODEL)
+    assert pool['hosts'][hosts['second']]['inflight']==2
+
+def test_select_sticky_slack(monkeypatch,hosts):
+    pool,clients=NewPool(monkeypatch,[hosts['healthy'],hosts['second']])
+    RefreshBackends(pool,clients)
+    pool['conversations']['chat']=hosts['healthy']
+    # The conversation stays on its host while it is no more than the slack busier
+    pool['hosts'][hosts['healthy']]['inflight']=BACKEND_STICKY_SLACK
+    assert SelectBackend(pool,clients,'chat',MODEL)==hosts['healthy']
+    # and moves once it is busier than that
+    pool['hosts'][hosts['healthy']]['inflight']=BACKEND_STICKY_SLACK+1
+    assert SelectBackend(pool,clients,'chat',MODEL)==hosts['second']
+    assert pool['conversations']['chat']==hosts['second']
+
+def test_select_fallback_when_no_host_has_the_model(monkeypatch,hosts):
+    pool,clients=NewPool(monkeypatch,[hosts['missing'],hosts['unreachable']])
+    # A new conversation goes to the first host, where the request reports the error
+    assert SelectBackend(pool,clients,'new','absent:1b')==hosts['missing']
+    # A conversation stays on its last host
+    pool['conversations']['old']=hosts['unreachable']
+    assert SelectBackend(pool,clients,'old','absent:1b')==hosts['unreachable']
+
+def test_unreachable_host_is_skipped_after_a_failed_request(monkeypatch,hosts):
+    pool,clients=NewPool(monkeypatch,[hosts['healthy'],hosts['second']])
+    RefreshBackends(pool,clients)
+    host=SelectBackend(pool,clients,'chat',MODEL)
+    EndRequest(pool,host,MODEL,httpx.ConnectError('refused'))
+    assert not pool['hosts'][host]['healthy']
+    other=hosts['healthy'] if host==hosts['second'] else hosts['second']
+    assert SelectBackend(pool,clients,'chat',MODEL)==other